@@ -23,6 +23,7 @@
 """
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.PyQt.QtCore import QSettings
+from qgis.PyQt.QtCore import QTimer
 from qgis.PyQt.QtCore import QTranslator
 from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtGui import QIcon
@@ -34,8 +35,11 @@ from qgis.core import QgsDataSourceUri
 from qgis.core import QgsGeometryGeneratorSymbolLayer
 from qgis.core import QgsMessageLog
 from qgis.core import QgsProject
+from qgis.core import QgsRectangle
 from qgis.core import QgsTask
+from qgis.core import QgsTaskManager
 from qgis.core import QgsVectorLayer
+from qgis.core import QgsVectorLayerTemporalProperties
 from qgis.core import QgsWkbTypes
 
 # Initialize Qt resources from file resources.py
@@ -43,13 +47,21 @@ from .resources import *
 
 # Import the code for the DockWidget
 import os.path
-import psycopg
+import time
 import uuid
 
 from .move_dockwidget import MoveDockWidget
-from .move_query import MoveQuery
+from .move_listener import MoveListener
+from .move_pool import MovePool
+from .move_settings import setting
+from .move_task import MoveChangesTask
+from .move_task import MoveCleanTask
 from .move_task import MoveGeomTask
+from .move_task import MovePrepareTask
+from .move_task import MoveRefreshTask
+from .move_task import MoveStageTask
 from .move_task import MoveTTask
+from .move_task import MoveTriggerTask
 
 
 class Move:
@@ -91,6 +103,28 @@ class Move:
 
         self.pluginIsActive = False
         self.dockwidget = None
+        self.pools = dict()
+        self.run_task_ids = []
+        self.refresh_queue = []
+        self.refreshing = set()
+        self.change_counters = dict()
+        self.changes_timer = QTimer()
+        self.changes_timer.timeout.connect(self.check_changes)
+        self.changes_task_id = None
+        self.listener = None
+        self.unstreamable = set()
+        self.stream_timer = QTimer()
+        self.stream_timer.timeout.connect(self.apply_stream)
+        self.stream_task_id = None
+        self.extending = set()
+        # Extents and windows are checked once the map stops moving
+        self.restrict_timer = QTimer()
+        self.restrict_timer.setSingleShot(True)
+        self.restrict_timer.timeout.connect(self.check_restrictions)
+        self.gc_timer = QTimer()
+        self.gc_timer.timeout.connect(self.collect_garbage)
+        self.gc_task_id = None
+        self.gc_last_run = 0
 
     # noinspection PyMethodMayBeStatic
     def tr(self, message):
@@ -200,6 +234,19 @@ class Move:
             self.onDbChanged)
         self.dockwidget.button_execute.clicked.disconnect(self.execute)
         self.dockwidget.button_refresh.clicked.disconnect(self.refresh)
+        self.dockwidget.button_refresh_all.clicked.disconnect(
+            self.refresh_all)
+        self.dockwidget.button_cancel.clicked.disconnect(self.cancel)
+
+        self.gc_timer.stop()
+        self.changes_timer.stop()
+        self.stop_streaming()
+        self.iface.mapCanvas().extentsChanged.disconnect(
+            self.schedule_restrictions)
+        self.iface.mapCanvas().temporalController(
+        ).temporalExtentsChanged.disconnect(self.schedule_restrictions)
+        self.restrict_timer.stop()
+        self.close_pools()
 
         # remove this statement if dockwidget is to remain
         # for reuse if plugin is reopened
@@ -243,9 +290,21 @@ class Move:
                 self.onDbChanged)
             self.dockwidget.button_execute.clicked.connect(self.execute)
             self.dockwidget.button_refresh.clicked.connect(self.refresh)
+            self.dockwidget.button_refresh_all.clicked.connect(
+                self.refresh_all)
+            self.dockwidget.button_cancel.clicked.connect(self.cancel)
 
             self.project_title = QgsProject.instance().title().lower().replace(" ", "_")
             self.setDatabaseComboBox()
+            self.gc_timer.start(setting('gc_interval_s') * 1000)
+            self.restrict_timer.setInterval(500)
+            self.iface.mapCanvas().extentsChanged.connect(
+                self.schedule_restrictions)
+            self.iface.mapCanvas().temporalController(
+            ).temporalExtentsChanged.connect(self.schedule_restrictions)
+            if setting('auto_refresh_interval_s') > 0:
+                self.changes_timer.start(
+                    setting('auto_refresh_interval_s') * 1000)
 
             # show the dockwidget
             # TODO: fix to allow choice of dock location
@@ -258,6 +317,7 @@ class Move:
         s.beginGroup("PostgreSQL/connections")
         db_names = s.childGroups()
         self.db_params = dict()
+        self.close_pools()
         if len(db_names) == 0:
             self.log("No Database Connections Available")
             self.set_execute_enabled(False)
@@ -270,6 +330,8 @@ class Move:
                     'username': s.value(f"{name}/username"),
                     'password': s.value(f"{name}/password")
                 }
+                self.pools[name] = MovePool(self.db_params[name],
+                                            setting('pool_size'))
                 self.dockwidget.combo_database.addItem(name)
             self.onDbChanged(db_names[0])
             self.set_execute_enabled(True)
@@ -279,118 +341,464 @@ class Move:
     def db(self):
         return self.db_params[self.current_db]
 
+    @property
+    def pool(self):
+        return self.pools[self.current_db]
+
     def onDbChanged(self, db_name):
         self.current_db = db_name
+        self.warm_pool()
+        if setting('streaming'):
+            self.start_streaming()
+        elif QgsProject.instance().readBoolEntry('move', 'streaming')[0]:
+            self.remove_triggers()
         # TODO: Maybe display textboxes for username and password
 
+    # Open a first connection in the background so that the first query
+    # does not pay for the connection handshake
+    def warm_pool(self):
+        pool = self.pool
+
+        def run(task):
+            pool.warm()
+
+        def completed(exception, result=None):
+            if exception is not None:
+                self.log(f"Exception: {exception}")
+
+        task = QgsTask.fromFunction(
+            f'Move: Connecting to {self.current_db}', run,
+            on_finished=completed)
+        self.tm.addTask(task)
+
+    # Listen to the changes of the source tables of the current database,
+    # after installing the notification triggers on those of the layers
+    def start_streaming(self):
+        self.stop_streaming()
+        self.unstreamable.clear()
+        self.listener = MoveListener(self.pool)
+        self.listener.start()
+        layers = QgsProject.instance().mapLayers().values()
+        base_names = [
+            base_name for base_name in self.get_layer_groups(layers)
+            if base_name is not None
+        ]
+        QgsProject.instance().writeEntry('move', 'streaming', True)
+        if base_names:
+            task = MoveTriggerTask("Move: Installing notification triggers",
+                                   self.project_title, self.pool, base_names,
+                                   self.log_triggers, self.raise_error)
+            self.tm.addTask(task)
+        self.stream_timer.start(setting('stream_interval_ms'))
+
+    def stop_streaming(self):
+        self.stream_timer.stop()
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    # Once streaming is turned off, the project stops using the
+    # notification triggers, which are only removed from the tables that
+    # no other project streams
+    def remove_triggers(self):
+        QgsProject.instance().removeEntry('move', 'streaming')
+        task = MoveTriggerTask("Move: Removing notification triggers",
+                               self.project_title, self.pool, None,
+                               self.log_triggers, self.raise_error, False)
+        self.tm.addTask(task)
+
+    def log_triggers(self, db, query, params):
+        if params['install']:
+            self.log("Listening to changes of: " +
+                     ", ".join(params['relations']))
+        elif params['relations']:
+            self.log("Notification triggers removed from: " +
+                     ", ".join(params['relations']))
+
+    # The notifications received since the previous call are handled as
+    # one batch, at most once per stream_interval_ms. While a batch is
+    # handled, the next one keeps growing.
+    def apply_stream(self):
+        if self.stream_task_id is not None and self.tm.task(
+                self.stream_task_id):
+            return
+        relations = self.listener.take()
+        if not relations:
+            return
+        layers = QgsProject.instance().mapLayers().values()
+        base_names = [
+            base_name for base_name in self.get_layer_groups(layers)
+            if base_name is not None
+        ]
+        task = MoveChangesTask("Move: Finding changed layers",
+                               self.project_title, self.pool, base_names,
+                               self.changes_checked, self.raise_error,
+                               list(relations))
+        self.stream_task_id = self.tm.addTask(task)
+
+    def close_pools(self):
+        for name, pool in self.pools.items():
+            stats = pool.stats()
+            self.log(f"Connection pool {name}: {stats['hits']} hits, "
+                     f"{stats['misses']} misses, {stats['waits']} waits")
+            pool.close()
+        self.pools = dict()
+
     def get_layer_view_names(self):
         view_names = []
         for layer in QgsProject.instance().mapLayers().values():
             view_name = layer.customProperty('move/view_name')
             if view_name is not None:
                 view_names.append(view_name)
-        view_name_strings = [f"'{name}'" for name in view_names]
-        view_names_string = ", ".join(view_name_strings)
-        return view_names_string
+            base_name = layer.customProperty('move/base_name')
+            if base_name is not None:
+                view_names.append(base_name)
+        return view_names
 
-    # Refresh materialized views of existing layers
+    # Refresh the view of the active layer
     def refresh(self):
-        self.dockwidget.button_refresh.setEnabled(False)
-        layer_name = self.iface.activeLayer().customProperty('move/view_name')
-        select_sql = f"refresh materialized view {layer_name};"
-
-        def run(task):
-            with psycopg.connect(
-                    host=self.db['host'],
-                    port=self.db['port'],
-                    dbname=self.db['database'],
-                    user=self.db['username'],
-                    password=self.db['password']) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(select_sql)
-                    conn.commit()
-
-        def completed(exception):
-            self.dockwidget.button_refresh.setEnabled(True)
-            if exception is not None:
-                self.log(f"Exception: {exception}")
-
-        if layer_name is not None:
-            task = QgsTask.fromFunction(
-                'Move: Refresh Active Layer', run, on_finished=completed)
+        layer = self.iface.activeLayer()
+        if layer is not None:
+            self.refresh_layers([layer])
+
+    # Refresh the views of all the layers of the project
+    def refresh_all(self):
+        self.refresh_layers(QgsProject.instance().mapLayers().values())
+
+    # Group the views of the layers by base table
+    def get_layer_groups(self, layers):
+        groups = dict()
+        for layer in layers:
+            view_name = layer.customProperty('move/view_name')
+            if view_name is None:
+                continue
+            base_name = layer.customProperty('move/base_name')
+            views = groups.setdefault(base_name, dict())
+            views.setdefault(view_name, []).append(layer)
+        return groups
+
+    # The views of the layers are refreshed by one task per base table, so
+    # that each query is re-run once, with at most refresh_parallelism
+    # tasks running at a time. Views shared by several layers are only
+    # refreshed once, and their layers repainted when the task is done.
+    # Queries already waiting or being refreshed are not queued again.
+    # Streamed refreshes only append the new data of the queries.
+    def refresh_layers(self, layers, stream=False):
+        queued = [base_name for base_name, _, _ in self.refresh_queue]
+        for base_name, views in self.get_layer_groups(layers).items():
+            if base_name in queued or base_name in self.refreshing:
+                continue
+            self.refresh_queue.append((base_name, views, stream))
+        self.start_refreshes()
+
+    def start_refreshes(self):
+        while (self.refresh_queue
+               and len(self.refreshing) < setting('refresh_parallelism')):
+            base_name, views, stream = self.refresh_queue.pop(0)
+            view_names = list(views)
+            task = MoveRefreshTask(
+                f"Move: Refreshing {', '.join(view_names)}",
+                self.project_title, self.pool, view_names,
+                lambda db, query, params, base_name=base_name, views=views:
+                self.refreshed(base_name, views, params),
+                self.raise_error, stream)
+            task.taskCompleted.connect(
+                lambda base_name=base_name: self.refresh_done(base_name))
+            task.taskTerminated.connect(
+                lambda base_name=base_name: self.refresh_done(base_name))
+            self.refreshing.add(base_name)
             self.tm.addTask(task)
+        self.set_refresh_enabled(not self.refresh_queue
+                                 and not self.refreshing)
+
+    # The queries that cannot be streamed are no longer refreshed when
+    # their sources change
+    def refreshed(self, base_name, views, params):
+        if params.get('refused'):
+            self.unstreamable.add(base_name)
+        for layers in views.values():
+            for layer in layers:
+                layer.triggerRepaint()
+
+    def refresh_done(self, base_name):
+        self.refreshing.discard(base_name)
+        self.start_refreshes()
+
+    # Check the source tables of the layer queries for changes, and refresh
+    # the layers whose sources changed since the previous check
+    def check_changes(self):
+        if not self.pools:
+            return
+        if self.changes_task_id is not None and self.tm.task(
+                self.changes_task_id):
+            return
+        layers = QgsProject.instance().mapLayers().values()
+        base_names = [
+            base_name for base_name in self.get_layer_groups(layers)
+            if base_name is not None
+        ]
+        if not base_names:
+            return
+        task = MoveChangesTask("Move: Checking source changes",
+                               self.project_title, self.pool, base_names,
+                               self.changes_checked, self.raise_error)
+        self.changes_task_id = self.tm.addTask(task)
+
+    def changes_checked(self, db, query, params):
+        if 'changed' in params:
+            changed = params['changed']
         else:
-            self.dockwidget.button_refresh.setEnabled(True)
-
-    # Drop unused materialized views
-    def clean(self):
-        select_sql = f"""
-            select 'drop materialized view ' || relname || ';'
-            from pg_class
-            where relkind = 'm'
-            and relname like 'move@_{self.project_title}@_%' escape '@'
-        """
-
-        view_names = self.get_layer_view_names()
-        if view_names:
-            select_sql += f" and relname not in ({view_names})"
-
-        try:
-            with psycopg.connect(
-                    host=self.db['host'],
-                    port=self.db['port'],
-                    dbname=self.db['database'],
-                    user=self.db['username'],
-                    password=self.db['password']) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(select_sql)
-                    drop_sqls = cur.fetchall()
-                    for drop_sql, in drop_sqls:
-                        cur.execute(drop_sql)
-                    conn.commit()
-        except psycopg.Error as e:
-            pass
+            changed = [
+                base_name for base_name, counter in params['counters'].items()
+                if self.change_counters.get(base_name, counter) != counter
+            ]
+            self.change_counters.update(params['counters'])
+        stream = 'changed' in params
+        if stream:
+            changed = [
+                base_name for base_name in changed
+                if base_name not in self.unstreamable
+            ]
+        if changed:
+            self.log("Sources changed for: " + ", ".join(changed))
+            self.refresh_layers([
+                layer for layer in QgsProject.instance().mapLayers().values()
+                if layer.customProperty('move/base_name') in changed
+            ], stream)
+
+    def set_refresh_enabled(self, enabled=True):
+        self.dockwidget.button_refresh.setEnabled(enabled)
+        self.dockwidget.button_refresh_all.setEnabled(enabled)
 
     def set_execute_enabled(self, enabled=True):
         self.dockwidget.button_execute.setEnabled(enabled)
         self.dockwidget.input_text.setReadOnly(not enabled)
 
-    # Execute current query
+    # Execute current query. Cleaning, parsing and type resolution run in
+    # a background task, which schedules the view tasks when it completes.
+    # A new execution replaces the one still running.
     def execute(self):
-        self.clean()
-        self.set_execute_enabled(False)
         raw_sql = self.dockwidget.input_text.toPlainText()
-        if raw_sql:
-            query = MoveQuery(raw_sql)
-            if not query.is_valid:
-                self.log(f"Invalid Query: {query}")
-            else:
-                self.log(f"Running Query: {query}")
-                self.run_query(query)
-        self.set_execute_enabled(True)
+        if not raw_sql:
+            return
+        self.cancel()
+        extent = None
+        if setting('extent_pushdown'):
+            extent = self.get_canvas_extent()
+        window = None
+        if setting('window_pushdown'):
+            window = self.get_animation_window()
+        task = MovePrepareTask("Move: Preparing query", raw_sql,
+                               self.project_title, self.pool, self.run_query,
+                               self.raise_error, extent, window)
+        self.run_task_ids.append(self.tm.addTask(task))
+        self.collect_garbage()
+
+    def get_canvas_extent(self):
+        canvas = self.iface.mapCanvas()
+        rect = canvas.extent()
+        srid = canvas.mapSettings().destinationCrs().postgisSrid()
+        return (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(),
+                rect.yMaximum(), srid)
+
+    # Animation range of the temporal controller, as UTC timestamps
+    def get_animation_window(self):
+        controller = self.iface.mapCanvas().temporalController()
+        extents = controller.temporalExtents()
+        if not extents.begin().isValid() or not extents.end().isValid():
+            return None
+        return (extents.begin().toUTC().toString(Qt.ISODate),
+                extents.end().toUTC().toString(Qt.ISODate))
+
+    def schedule_restrictions(self, *args):
+        self.restrict_timer.start()
+
+    # Extend the views of the layers restricted to a map extent or a time
+    # window when the map is moved outside of the extent, or the animation
+    # range outside of the window. The query of the layers is executed
+    # again for the union of the extents and windows, and its new views
+    # replace the data source of the layers.
+    def check_restrictions(self):
+        if not self.pools:
+            return
+        xmin, ymin, xmax, ymax, srid = self.get_canvas_extent()
+        canvas_rect = QgsRectangle(xmin, ymin, xmax, ymax)
+        canvas_window = None
+        if setting('window_pushdown'):
+            canvas_window = self.get_animation_window()
+        restrictions = dict()
+        for layer in QgsProject.instance().mapLayers().values():
+            sql = layer.customProperty('move/sql')
+            extent = layer.customProperty('move/extent')
+            window = layer.customProperty('move/window')
+            if sql in self.extending or (extent is None and window is None):
+                continue
+            restriction = restrictions.setdefault(sql, {
+                'extent': None,
+                'window': None,
+                'changed': False
+            })
+            if extent is not None:
+                extent = [float(value) for value in extent.split(",")]
+                rect = QgsRectangle(*extent[:4])
+                if (setting('extent_pushdown') and int(extent[4]) == srid
+                        and not rect.contains(canvas_rect)):
+                    rect.combineExtentWith(canvas_rect)
+                    restriction['changed'] = True
+                if restriction['extent'] is not None:
+                    rect.combineExtentWith(restriction['extent'][0])
+                restriction['extent'] = (rect, int(extent[4]))
+            if window is not None:
+                start, end = window.split(",")
+                if canvas_window is not None and (canvas_window[0] < start
+                                                  or canvas_window[1] > end):
+                    start = min(start, canvas_window[0])
+                    end = max(end, canvas_window[1])
+                    restriction['changed'] = True
+                if restriction['window'] is not None:
+                    start = min(start, restriction['window'][0])
+                    end = max(end, restriction['window'][1])
+                restriction['window'] = (start, end)
+        for sql, restriction in restrictions.items():
+            if not restriction['changed']:
+                continue
+            self.extending.add(sql)
+            extent = None
+            if restriction['extent'] is not None:
+                rect, extent_srid = restriction['extent']
+                extent = (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(),
+                          rect.yMaximum(), extent_srid)
+            task = MovePrepareTask(
+                "Move: Extending views", sql, self.project_title, self.pool,
+                lambda db, query, params, sql=sql: self.extend_layers(
+                    sql, db, query, params),
+                lambda error_msg, sql=sql: self.extend_failed(
+                    sql, error_msg), extent, restriction['window'], False)
+            self.tm.addTask(task)
 
-    def run_query(self, query):
-        if not query.resolve_types(self.db):
-            self.log("Error: " + query.error_msg)
+    def extend_layers(self, sql, db, query, params):
+        self.extending.discard(sql)
+        for layer in QgsProject.instance().mapLayers().values():
+            if (layer.customProperty('move/sql') != sql
+                    or layer.name() not in query.column_names):
+                continue
+            col_id = query.column_names.index(layer.name())
+            if col_id in query.temp_cols():
+                view_name = query.get_view_name(
+                    self.project_title, query.get_temporal_kind(col_id),
+                    col_id)
+            else:
+                view_name = query.get_view_name(self.project_title, 'geom')
+            layer.setCustomProperty('move/preview_of', view_name)
+        self.run_query(db, query, dict(params, preview=None))
+
+    def extend_failed(self, sql, error_msg):
+        self.extending.discard(sql)
+        self.raise_error(error_msg)
+
+    # Drop unused views in the background. Runs periodically and after
+    # executions, but never more than once per gc_min_interval_s seconds.
+    def collect_garbage(self):
+        if not self.pools:
+            return
+        if self.gc_task_id is not None and self.tm.task(self.gc_task_id):
             return
+        if time.monotonic() - self.gc_last_run < setting('gc_min_interval_s'):
+            return
+        self.gc_last_run = time.monotonic()
+        task = MoveCleanTask("Move: Dropping unused views",
+                             self.project_title, self.pool,
+                             self.get_layer_view_names(), self.log_collected,
+                             self.raise_error)
+        self.gc_task_id = self.tm.addTask(task)
+
+    def log_collected(self, db, query, params):
+        if params['evicted']:
+            self.log("Evicted queries: " + ", ".join(params['evicted']))
+        if params['dropped']:
+            self.log("Dropped unused views: " + ", ".join(params['dropped']))
+
+    # Cancel the tasks of the current execution
+    def cancel(self):
+        for task_id in self.run_task_ids:
+            task = self.tm.task(task_id)
+            if task is not None:
+                task.cancel()
+        self.run_task_ids = []
+
+    def run_query(self, db, query, params):
+        self.log(f"Running Query: {query}")
         self.log("Query return types: " + ", ".join(query.column_types))
+        if not query.has_geom_columns() and not query.has_temp_columns():
+            return
+        # Views built by a previous execution of the same query are reused
+        existing = params['existing']
+        # A sample of the query is shown first, and its layers are replaced
+        # by the full ones as they are built
+        preview = params['preview']
+        names = query.get_relation_names(self.project_title)
+        if preview is not None and any(name not in existing
+                                       for name in names[1:]):
+            self.schedule_query(db, preview, existing, query)
+        self.schedule_query(db, query, existing)
+
+    # Schedule the tasks that build the views of the query, or add the
+    # layers of the views that already exist. The layers of a preview
+    # query are marked as previews of the views of full_query.
+    def schedule_query(self, db, query, existing, full_query=None):
+        stage_task = None
+
+        def schedule(task):
+            if stage_task is None:
+                self.run_task_ids.append(self.tm.addTask(task))
+            else:
+                self.run_task_ids.append(
+                    self.tm.addTask(
+                        QgsTaskManager.TaskDefinition(task, [stage_task])))
+
+        def preview_of(add_layer, kind, col_id=None):
+            if full_query is None:
+                return add_layer
+            full_name = full_query.get_view_name(self.project_title, kind,
+                                                 col_id)
+            return lambda db, query, params: add_layer(
+                db, query, dict(params, preview_of=full_name))
+
+        # The query is run once into the base table, and every view
+        # task waits for it to complete
+        if query.get_base_name(self.project_title) not in existing:
+            stage_task = MoveStageTask("Move: Staging query", query,
+                                       self.project_title, self.pool,
+                                       self.log_staged, self.raise_error)
+            self.run_task_ids.append(self.tm.addTask(stage_task))
         if query.has_geom_columns():
-            task = MoveGeomTask("Move: Creating geom view", query,
-                                self.project_title, self.db,
-                                self.add_geom_layers, self.raise_error)
-            self.tm.addTask(task)
-        if query.has_temp_columns():
-            temp_cols = query.temp_cols()
-            for col in temp_cols:
-                if query.column_types[col] == 'tgeometry':
-                    task = MoveTTask(f"Move: Creating tgeom view {col}", query,
-                                     self.project_title, self.db, col,
-                                     self.add_tgeom_layer, self.raise_error)
-                else:
-                    task = MoveTTask(f"Move: Creating tpoint view {col}",
-                                     query, self.project_title, self.db, col,
-                                     self.add_tpoint_layer, self.raise_error)
-                self.tm.addTask(task)
+            view_name = query.get_view_name(self.project_title, 'geom')
+            add_layer = preview_of(self.add_geom_layers, 'geom')
+            if view_name in existing:
+                self.log(f"Reusing view {view_name}")
+                add_layer(db, query, existing[view_name])
+            else:
+                task = MoveGeomTask("Move: Creating geom view", query,
+                                    self.project_title, self.pool,
+                                    add_layer, self.raise_error)
+                schedule(task)
+        for col in query.temp_cols():
+            kind = query.get_temporal_kind(col)
+            add_layer = preview_of(
+                self.add_tgeom_layer
+                if kind == 'tgeom' else self.add_tpoint_layer, kind, col)
+            view_name = query.get_view_name(self.project_title, kind, col)
+            if view_name in existing:
+                self.log(f"Reusing view {view_name}")
+                add_layer(db, query, existing[view_name])
+            else:
+                task = MoveTTask(f"Move: Creating {kind} view {col}", query,
+                                 self.project_title, self.pool, col,
+                                 add_layer, self.raise_error)
+                schedule(task)
+
+    def log_staged(self, db, query, params):
+        self.log(f"Query staged in {params['base_name']}")
 
     def raise_error(self, msg):
         if msg:
@@ -398,6 +806,54 @@ class Move:
         else:
             self.log("Unknown error")
 
+    # Add a layer for the view, unless it is a preview and the layer of the
+    # full view is already there. The layer of the full view replaces the
+    # data source of its preview layer, which keeps the layer styling.
+    # Returns the layer, or None, and whether it was added.
+    def load_layer(self, uri, layer_name, query, params):
+        view_name = params['view_name']
+        preview_of = params.get('preview_of')
+        layer = None
+        for other in QgsProject.instance().mapLayers().values():
+            if other.name() != layer_name:
+                continue
+            if (preview_of is not None
+                    and other.customProperty('move/view_name') == preview_of):
+                return None, False
+            if (preview_of is None
+                    and other.customProperty('move/preview_of') == view_name
+                    and other.wkbType() == uri.wkbType()):
+                layer = other
+                break
+        if layer is not None:
+            layer.setDataSource(uri.uri(), layer_name, "postgres")
+            layer.removeCustomProperty('move/preview_of')
+            added = False
+        else:
+            layer = self.iface.addVectorLayer(uri.uri(), layer_name,
+                                              "postgres")
+            if not layer or not layer.isValid():
+                self.msg("Layer failed to load!")
+                self.log(
+                    f"Failed to load layer {layer_name} from view {view_name}")
+                return None, False
+            if preview_of is not None:
+                layer.setCustomProperty('move/preview_of', preview_of)
+            added = True
+        layer.setCustomProperty('move/view_name', view_name)
+        layer.setCustomProperty('move/base_name', params['base_name'])
+        layer.setCustomProperty('move/sql', query.raw_sql)
+        if query.extent is not None:
+            layer.setCustomProperty('move/extent',
+                                    ",".join(map(str, query.extent)))
+        else:
+            layer.removeCustomProperty('move/extent')
+        if query.window is not None:
+            layer.setCustomProperty('move/window', ",".join(query.window))
+        else:
+            layer.removeCustomProperty('move/window')
+        return layer, added
+
     def add_geom_layers(self, db, query, params):
         view_name = params['view_name']
         col_names = params['col_names']
@@ -414,13 +870,7 @@ class Move:
                 uri.setSrid(str(srids[i]))
                 uri.setWkbType(QgsWkbTypes.parseType(col_type))
                 layer_name = col_names[i]
-                layer = self.iface.addVectorLayer(uri.uri(), layer_name,
-                                                  "postgres")
-                if not layer or not layer.isValid():
-                    self.msg("Layer failed to load!")
-                else:
-                    layer.setCustomProperty('move/view_name', view_name)
-                    layer.setCustomProperty('move/sql', query.raw_sql)
+                self.load_layer(uri, layer_name, query, params)
 
     def add_tpoint_layer(self, db, query, params):
         view_name = params['view_name']
@@ -429,16 +879,15 @@ class Move:
                           db['username'], db['password'],
                           QgsDataSourceUri.SslDisable)
         uri.setDataSource("public", view_name, "geom", "", "id")
-        uri.setSrid(str(params['srid']))
+        if params['srid'] is not None:
+            uri.setSrid(str(params['srid']))
         uri.setWkbType(QgsWkbTypes.LineStringM)
         layer_name = query.column_names[params['col_id']]
-        layer = self.iface.addVectorLayer(uri.uri(), layer_name, "postgres")
-        if not layer or not layer.isValid():
-            self.msg("Layer failed to load!")
-        else:
-            layer.setCustomProperty('move/view_name', view_name)
-            layer.setCustomProperty('move/sql', query.raw_sql)
-            layer.temporalProperties().setIsActive(True)
+        layer, added = self.load_layer(uri, layer_name, query, params)
+        if added:
+            self.set_temporal_properties(layer)
+            # The m values of the segments are UTC epochs, like the epoch of
+            # the map time, so no time zone offset is needed
             pointGeneratorLayer = QgsGeometryGeneratorSymbolLayer.create({
                 'SymbolType':
                 'Marker',
@@ -457,17 +906,29 @@ class Move:
                           QgsDataSourceUri.SslDisable)
         uri.setDataSource("public", view_name, "geom")
         uri.setKeyColumn("id")
-        uri.setSrid(str(params['srid']))
+        if params['srid'] is not None:
+            uri.setSrid(str(params['srid']))
         uri.setWkbType(QgsWkbTypes.Polygon)
         layer_name = query.column_names[params['col_id']]
-        layer = self.iface.addVectorLayer(uri.uri(), layer_name, "postgres")
-        if not layer or not layer.isValid():
-            self.log(
-                f"Failed to load layer {layer_name} from view {view_name}")
-        else:
-            layer.setCustomProperty('move/view_name', view_name)
-            layer.setCustomProperty('move/sql', query.raw_sql)
-            layer.temporalProperties().setIsActive(True)
+        layer, added = self.load_layer(uri, layer_name, query, params)
+        if added:
+            self.set_temporal_properties(layer)
+
+    # Filters the features of a temporal layer on the start_t and end_t
+    # fields, so that the query of each frame is sent to the database
+    # with a time range that the indexes of the view can serve
+    def set_temporal_properties(self, layer):
+        properties = layer.temporalProperties()
+        properties.setMode(
+            QgsVectorLayerTemporalProperties.ModeFeatureDateTimeStartAndEndFromFields)
+        properties.setStartField('start_t')
+        properties.setEndField('end_t')
+        # The segment ending at the start of a frame is kept, since its end
+        # point is drawn in the frame (QGIS >= 3.22)
+        if hasattr(properties, 'setLimitMode'):
+            properties.setLimitMode(
+                Qgis.VectorTemporalLimitMode.IncludeBeginIncludeEnd)
+        properties.setIsActive(True)
 
     def msg(self, msg):
         self.iface.messageBar().pushMessage(msg, level=Qgis.Info, duration=3)
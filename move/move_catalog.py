@@ -0,0 +1,421 @@
+from psycopg.types.json import Jsonb
+
+
+# Total size of the relation named by the SQL expression name, including
+# the partitions of a partitioned table
+def get_size_sql(name):
+    return f"""coalesce(
+        (select sum(pg_total_relation_size(relid))
+        from pg_partition_tree(to_regclass('public.' || {name}))),
+        pg_total_relation_size(to_regclass('public.' || {name})))"""
+
+
+# Returns the (name, relkind) pairs of the existing relations among names
+def get_relkinds(cur, names):
+    cur.execute("""
+        select relname, relkind
+        from pg_class
+        where relnamespace = 'public'::regnamespace
+        and relname = any(%s)
+    """, (list(names), ))
+    return cur.fetchall()
+
+
+# Drops the given (name, relkind) relations in batches. Materialized views
+# are dropped first, since they may depend on a base table.
+def drop_relations(cur, relations, batch_size=50):
+    views = [name for name, kind in relations if kind == 'm']
+    tables = [name for name, kind in relations if kind != 'm']
+    for i in range(0, len(views), batch_size):
+        batch = ", ".join(views[i:i + batch_size])
+        cur.execute(f"drop materialized view if exists {batch}")
+    for i in range(0, len(tables), batch_size):
+        batch = ", ".join(tables[i:i + batch_size])
+        cur.execute(f"drop table if exists {batch} cascade")
+
+
+class MoveCatalog:
+    """Catalog of the base tables and views built by the plugin.
+
+    The catalog is a table of the move schema that records, for every
+    relation, the query it was built from, its size, row count, build time
+    and last access. Unused relations are kept until the disk budget of
+    their project is exceeded, and are then evicted by least recent access.
+
+    Relations are reserved in the catalog before they are built, so that
+    the garbage collection never drops a relation that is being built.
+    Reservations older than build_timeout are assumed to be left over by
+    a build that never finished.
+
+    The notification triggers installed by the plugin are recorded in a
+    second table, with the projects that stream the changes of each table.
+    A trigger is only removed once no project uses it anymore, and never
+    if the plugin did not install it.
+    """
+
+    build_timeout = '1 day'
+
+    def __init__(self, project_title):
+        self.project_title = project_title
+
+    def ensure(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("create schema if not exists move")
+            cur.execute("""
+                create table if not exists move.views (
+                    view_name text primary key,
+                    base_name text not null,
+                    project text not null,
+                    kind text not null,
+                    fingerprint text not null,
+                    source_sql text not null,
+                    select_sql text,
+                    params jsonb not null default '{}',
+                    building boolean not null default false,
+                    size_bytes bigint,
+                    row_count bigint,
+                    build_seconds double precision,
+                    created timestamptz not null default now(),
+                    last_access timestamptz not null default now()
+                )
+            """)
+            cur.execute("""
+                create table if not exists move.triggers (
+                    relation text not null,
+                    project text not null,
+                    primary key (relation, project)
+                )
+            """)
+            conn.commit()
+
+    # Condition on the rows of the catalog of relations still being built
+    def get_building_sql(self):
+        return f"building and created > now() - interval '{self.build_timeout}'"
+
+    # Records that a relation is about to be built, by default the view of
+    # the given kind of the query. Fails if it is already being built, so
+    # that a relation is only built, and dropped on failure, by the task
+    # holding its reservation.
+    def reserve(self, conn, query, kind, col_id=None, view_name=None):
+        if view_name is None and kind == 'base':
+            view_name = query.get_base_name(self.project_title)
+        elif view_name is None:
+            view_name = query.get_view_name(self.project_title, kind, col_id)
+        sql = f"""
+            insert into move.views (view_name, base_name, project, kind,
+                fingerprint, source_sql, building)
+            values (%(view_name)s, %(base_name)s, %(project)s, %(kind)s,
+                %(fingerprint)s, %(source_sql)s, true)
+            on conflict (view_name) do update set
+                building = true,
+                created = now(),
+                last_access = now()
+            where not ({self.get_building_sql()})
+            returning view_name
+        """
+        with conn.cursor() as cur:
+            cur.execute(sql, {
+                'view_name': view_name,
+                'base_name': query.get_base_name(self.project_title),
+                'project': self.project_title,
+                'kind': kind,
+                'fingerprint': query.get_fingerprint(kind, col_id),
+                'source_sql': query.raw_sql
+            })
+            reserved = cur.fetchone() is not None
+            conn.commit()
+        if not reserved:
+            raise ValueError(f"{view_name} is already being built")
+
+    # Forgets the reservations of the given relations, without committing
+    def release(self, conn, names):
+        with conn.cursor() as cur:
+            cur.execute(
+                "delete from move.views where view_name = any(%s) and building",
+                (list(names), ))
+
+    def register(self, conn, query, kind, col_id, params, progress):
+        if kind == 'base':
+            view_name = query.get_base_name(self.project_title)
+        else:
+            view_name = query.get_view_name(self.project_title, kind, col_id)
+        build_seconds = sum(duration for _, duration in progress.durations)
+        sql = f"""
+            insert into move.views (view_name, base_name, project, kind,
+                fingerprint, source_sql, select_sql, params, size_bytes,
+                row_count, build_seconds)
+            values (%(view_name)s, %(base_name)s, %(project)s, %(kind)s,
+                %(fingerprint)s, %(source_sql)s, %(select_sql)s, %(params)s,
+                {get_size_sql('%(view_name)s')},
+                %(row_count)s, %(build_seconds)s)
+            on conflict (view_name) do update set
+                building = false,
+                select_sql = excluded.select_sql,
+                params = excluded.params,
+                size_bytes = excluded.size_bytes,
+                row_count = excluded.row_count,
+                build_seconds = excluded.build_seconds,
+                created = now(),
+                last_access = now()
+        """
+        with conn.cursor() as cur:
+            cur.execute(sql, {
+                'view_name': view_name,
+                'base_name': query.get_base_name(self.project_title),
+                'project': self.project_title,
+                'kind': kind,
+                'fingerprint': query.get_fingerprint(kind, col_id),
+                'source_sql': query.raw_sql,
+                'select_sql': query.get_select_sql(self.project_title, kind,
+                                                   col_id),
+                'params': Jsonb(params),
+                'row_count': progress.rows,
+                'build_seconds': build_seconds
+            })
+            conn.commit()
+
+    # Returns the layer parameters of the catalogued relations among names
+    # that exist and are populated
+    def lookup(self, conn, names):
+        sql = """
+            select v.view_name, v.base_name, v.params
+            from move.views v
+            join pg_class c
+            on c.relnamespace = 'public'::regnamespace
+            and c.relname = v.view_name
+            left join pg_matviews m
+            on m.schemaname = 'public' and m.matviewname = v.view_name
+            where v.view_name = any(%s)
+            and not v.building
+            and coalesce(m.ispopulated, true)
+        """
+        existing = dict()
+        with conn.cursor() as cur:
+            cur.execute(sql, (names, ))
+            for view_name, base_name, params in cur.fetchall():
+                params['view_name'] = view_name
+                params['base_name'] = base_name
+                existing[view_name] = params
+        return existing
+
+    # Updates the last access and size of the given relations
+    def touch(self, conn, names):
+        sql = f"""
+            update move.views
+            set last_access = now(),
+                size_bytes = coalesce({get_size_sql('view_name')}, size_bytes)
+            where view_name = any(%s)
+        """
+        with conn.cursor() as cur:
+            cur.execute(sql, (list(names), ))
+            conn.commit()
+
+    # Drops the least recently used queries of the project, each with its
+    # base table and views, until the project fits in budget bytes.
+    # Queries with a relation in keep_names or being built are never
+    # dropped. The drops are sent in batches, and committed by the caller.
+    def evict(self, conn, keep_names, budget, batch_size=50):
+        forget_sql = f"""
+            delete from move.views
+            where project = %s
+            and to_regclass('public.' || view_name) is null
+            and not ({self.get_building_sql()})
+        """
+        groups_sql = f"""
+            select base_name,
+                coalesce(sum(size_bytes), 0),
+                bool_or(view_name = any(%s) or {self.get_building_sql()})
+            from move.views
+            where project = %s
+            group by base_name
+            order by max(last_access)
+        """
+        evicted = []
+        with conn.cursor() as cur:
+            cur.execute(forget_sql, (self.project_title, ))
+            cur.execute(groups_sql, (list(keep_names), self.project_title))
+            groups = cur.fetchall()
+            total = sum(size for _, size, _ in groups)
+            for base_name, size, kept in groups:
+                if total <= budget:
+                    break
+                if kept:
+                    continue
+                total -= size
+                evicted.append(base_name)
+            cur.execute(
+                "select view_name from move.views where base_name = any(%s)",
+                (evicted, ))
+            names = [name for name, in cur.fetchall()]
+            drop_relations(cur, get_relkinds(cur, names), batch_size)
+            cur.execute("delete from move.views where base_name = any(%s)",
+                        (evicted, ))
+        return evicted
+
+    # Returns what is needed to rebuild a view: its base table and the
+    # queries that fill them, its kind and whether it is a materialized
+    # view or a table. Returns None for views missing from the catalog.
+    def get_sources(self, conn, view_name):
+        sql = """
+            select v.base_name, b.select_sql, v.kind, v.source_sql,
+                v.select_sql, v.params, c.relkind
+            from move.views v
+            join move.views b on b.view_name = v.base_name
+            join pg_class c on c.oid = to_regclass('public.' || v.view_name)
+            where v.view_name = %s
+        """
+        with conn.cursor() as cur:
+            cur.execute(sql, (view_name, ))
+            res = cur.fetchone()
+        if res is None:
+            return None
+        keys = ['base_name', 'base_sql', 'kind', 'source_sql', 'select_sql',
+                'params', 'relkind']
+        return dict(zip(keys, res))
+
+    # Returns the sum of the inserted, updated and deleted row counters of
+    # the source tables of each of the given base tables. Base tables
+    # registered without their sources are left out.
+    def get_change_counters(self, conn, base_names):
+        sql = """
+            select v.view_name,
+                sum(s.n_tup_ins + s.n_tup_upd + s.n_tup_del)::bigint
+            from move.views v
+            cross join jsonb_array_elements_text(v.params -> 'sources') r
+            join pg_stat_user_tables s on s.relid = to_regclass(r.value)
+            where v.view_name = any(%s)
+            and v.kind = 'base'
+            group by v.view_name
+        """
+        with conn.cursor() as cur:
+            cur.execute(sql, (list(base_names), ))
+            return dict(cur.fetchall())
+
+    # Merges params into the layer parameters of a view, without committing
+    def update_params(self, conn, view_name, params):
+        sql = """
+            update move.views
+            set params = params || %s
+            where view_name = %s
+        """
+        with conn.cursor() as cur:
+            cur.execute(sql, (Jsonb(params), view_name))
+
+    # Returns the tables, among relations, that have the notification
+    # trigger
+    def get_triggered(self, conn, relations):
+        sql = """
+            select r
+            from unnest(%s::text[]) r
+            where exists (
+                select 1 from pg_trigger
+                where tgrelid = to_regclass(r) and tgname = 'move_notify')
+        """
+        with conn.cursor() as cur:
+            cur.execute(sql, (list(relations), ))
+            return [relation for relation, in cur.fetchall()]
+
+    # Installs on the given tables a statement trigger that notifies the
+    # move channel of their changes, with the table name as payload, and
+    # records that the project uses the triggers installed by the plugin.
+    # Tables that already have it are left alone, so that they are only
+    # locked once. Returns the tables on which the trigger was installed.
+    def install_triggers(self, conn, relations):
+        with conn.cursor() as cur:
+            # Serializes with the removal of the triggers by other clients
+            cur.execute("lock table move.triggers in exclusive mode")
+            cur.execute(
+                "select distinct relation from move.triggers where relation = any(%s)",
+                (list(relations), ))
+            owned = [relation for relation, in cur.fetchall()]
+        triggered = self.get_triggered(conn, relations)
+        missing = [
+            relation for relation in relations if relation not in triggered
+        ]
+        with conn.cursor() as cur:
+            cur.execute("""
+                insert into move.triggers (relation, project)
+                select r, %s from unnest(%s::text[]) r
+                on conflict do nothing
+            """, (self.project_title, sorted(set(owned + missing))))
+            if not missing:
+                conn.commit()
+                return missing
+            cur.execute("""
+                create or replace function move.notify_change()
+                returns trigger language plpgsql as $$
+                begin
+                    perform pg_notify('move',
+                        tg_table_schema || '.' || tg_table_name);
+                    return null;
+                end;
+                $$
+            """)
+            for relation in missing:
+                cur.execute(f"""
+                    create trigger move_notify
+                    after insert or update or delete or truncate
+                    on {relation}
+                    for each statement
+                    execute function move.notify_change()
+                """)
+            conn.commit()
+        return missing
+
+    # Forgets that the project uses the notification triggers, and removes
+    # those that no other project uses. Returns the tables from which the
+    # trigger was removed.
+    def uninstall_triggers(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("select to_regclass('move.triggers') is not null")
+            if not cur.fetchone()[0]:
+                return []
+            cur.execute("lock table move.triggers in exclusive mode")
+            cur.execute("""
+                delete from move.triggers t
+                where t.project = %s
+                and not exists (
+                    select 1 from move.triggers o
+                    where o.relation = t.relation and o.project <> t.project)
+                returning t.relation
+            """, (self.project_title, ))
+            unused = [relation for relation, in cur.fetchall()]
+            cur.execute("delete from move.triggers where project = %s",
+                        (self.project_title, ))
+        triggered = self.get_triggered(conn, unused)
+        with conn.cursor() as cur:
+            for relation in triggered:
+                cur.execute(f"drop trigger move_notify on {relation}")
+            conn.commit()
+        return triggered
+
+    # Returns the source tables of the given base tables, or of all the
+    # base tables of the project without base_names
+    def get_source_relations(self, conn, base_names=None):
+        sql = """
+            select distinct r.value
+            from move.views v
+            cross join jsonb_array_elements_text(v.params -> 'sources') r
+            where (v.view_name = any(%s) or %s::text[] is null)
+            and v.project = %s
+            and v.kind = 'base'
+        """
+        if base_names is not None:
+            base_names = list(base_names)
+        with conn.cursor() as cur:
+            cur.execute(sql, (base_names, base_names, self.project_title))
+            return [relation for relation, in cur.fetchall()]
+
+    # Returns the base tables, among base_names, that read any of the given
+    # tables
+    def get_readers(self, conn, base_names, relations):
+        sql = """
+            select v.view_name
+            from move.views v
+            where v.view_name = any(%s)
+            and v.kind = 'base'
+            and v.params -> 'sources' ?| %s
+        """
+        with conn.cursor() as cur:
+            cur.execute(sql, (list(base_names), list(relations)))
+            return [base_name for base_name, in cur.fetchall()]
@@ -0,0 +1,88 @@
+import psycopg
+import re
+import threading
+
+from qgis.core import Qgis
+from qgis.core import QgsMessageLog
+
+
+class MoveListener:
+    """Listener of the changes notified by the triggers of the source tables.
+
+    A thread keeps its own connection to the database, outside of the
+    pool, and LISTENs on the move channel. The names of the tables that
+    changed are collected until they are taken by the plugin, so that
+    the notifications received in between are handled as one batch.
+
+    Notifications are awaited with a timeout from psycopg 3.2. With older
+    versions, they are received by a handler while the connection is
+    polled every timeout seconds.
+    """
+
+    channel = 'move'
+    timeout = 1
+    retry_interval = 5
+    connect_timeout = 10
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.changed = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def has_notifies_timeout():
+        major, minor = re.match(r"(\d+)\.(\d+)", psycopg.__version__).groups()
+        return (int(major), int(minor)) >= (3, 2)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                with self.pool.connect(
+                        connect_timeout=self.connect_timeout) as conn:
+                    conn.autocommit = True
+                    conn.execute(f"listen {self.channel}")
+                    if self.has_notifies_timeout():
+                        self.wait_notifies(conn)
+                    else:
+                        self.poll_notifies(conn)
+            except psycopg.Error:
+                # The connection is opened again after a while
+                self.stopped.wait(self.retry_interval)
+            except Exception as e:
+                QgsMessageLog.logMessage(f"Listener stopped: {e}", 'Move',
+                                         level=Qgis.Critical)
+                return
+
+    def add(self, notify):
+        with self.lock:
+            self.changed.add(notify.payload)
+
+    def wait_notifies(self, conn):
+        while not self.stopped.is_set():
+            for notify in conn.notifies(timeout=self.timeout):
+                self.add(notify)
+
+    def poll_notifies(self, conn):
+        conn.add_notify_handler(self.add)
+        while not self.stopped.wait(self.timeout):
+            conn.execute("select 1")
+
+    # Returns the tables that changed since the previous call
+    def take(self):
+        with self.lock:
+            changed, self.changed = self.changed, set()
+        return changed
+
+    # Called from the GUI thread, which is never blocked on a thread still
+    # connecting: being a daemon, it ends by itself once connected
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(self.timeout)
+            self.thread = None
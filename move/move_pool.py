@@ -0,0 +1,130 @@
+import psycopg
+import threading
+
+from contextlib import contextmanager
+from psycopg import pq
+
+
+class MovePool:
+    """Pool of database connections for one connection profile.
+
+    Connections are opened lazily up to max_size and handed out to one
+    borrower at a time, so the pool can be shared by the GUI thread and
+    the background tasks.
+    """
+
+    def __init__(self, db, max_size=4):
+        self.db = db
+        self.max_size = max_size
+        self.idle = []
+        self.size = 0
+        self.closed = False
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        # Type names by oid, shared by all connections of the profile
+        self.type_names = dict()
+        # Whether the catalog tables are known to exist in the database
+        self.catalog_ready = False
+        self.cond = threading.Condition()
+
+    def connect(self, **kwargs):
+        return psycopg.connect(
+            host=self.db['host'],
+            port=self.db['port'],
+            dbname=self.db['database'],
+            user=self.db['username'],
+            password=self.db['password'],
+            **kwargs)
+
+    # Without wait, returns None instead of waiting for a connection when
+    # all of them are in use
+    def getconn(self, wait=True):
+        conn = None
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise psycopg.OperationalError("Connection pool is closed")
+                if self.idle:
+                    conn = self.idle.pop()
+                    if conn.closed or conn.broken:
+                        self.size -= 1
+                        conn = None
+                        continue
+                    self.hits += 1
+                    return conn
+                if self.size < self.max_size:
+                    self.size += 1
+                    self.misses += 1
+                    break
+                if not wait:
+                    return None
+                self.waits += 1
+                self.cond.wait()
+        try:
+            return self.connect()
+        except BaseException:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def putconn(self, conn):
+        if not conn.closed and not conn.broken:
+            if conn.info.transaction_status != pq.TransactionStatus.IDLE:
+                try:
+                    conn.rollback()
+                except psycopg.Error:
+                    conn.close()
+        with self.cond:
+            if self.closed or conn.closed or conn.broken:
+                self.size -= 1
+                conn.close()
+            else:
+                self.idle.append(conn)
+            self.cond.notify()
+
+    # Borrow a connection for the duration of a with block. The open
+    # transaction is committed on success and rolled back on error.
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        except BaseException:
+            self.putconn(conn)
+            raise
+        try:
+            if conn.info.transaction_status == pq.TransactionStatus.INTRANS:
+                conn.commit()
+        finally:
+            self.putconn(conn)
+
+    # Open connections until n of them are available
+    def warm(self, n=1):
+        conns = []
+        try:
+            while len(conns) < min(n, self.max_size):
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits
+            }
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.cond.notify_all()
+        for conn in idle:
+            conn.close()
@@ -1,13 +1,54 @@
-import psycopg
-import uuid
+import hashlib
+import re
+
+from contextlib import nullcontext
+from datetime import timedelta
+from datetime import timezone
+from psycopg import Pipeline
+from psycopg import pq
+
+
+# Sends the statements executed in the block in a single round trip when
+# the libpq version supports pipeline mode
+def pipeline(conn):
+    if Pipeline.is_supported():
+        return conn.pipeline()
+    return nullcontext()
 
 
 class MoveQuery:
+    # Durations from which the size of the partitions of temporal views is
+    # chosen
+    partition_steps = [
+        timedelta(hours=1),
+        timedelta(days=1),
+        timedelta(weeks=1),
+        timedelta(days=30),
+        timedelta(days=365)
+    ]
+
+    # Percentage of the pages of its table, and number of rows, of the
+    # sample of a query from which the rows of its temporal views are
+    # estimated
+    sample_percent = 1
+    sample_rows = 1000
+
     def __init__(self, raw_sql):
         super(MoveQuery, self).__init__()
-        self.id = uuid.uuid4().hex
         self.raw_sql = raw_sql
         self.is_valid = True
+        # Views are materialized as materialized views, or as unlogged
+        # tables with "table"
+        self.materialization = 'view'
+        # Temporal views are partitioned by start_t into about this number
+        # of partitions when it is not 0
+        self.partitions = 0
+        # Map extent as (xmin, ymin, xmax, ymax, srid), to which the views
+        # are restricted when it is set
+        self.extent = None
+        # Time window as (start, end) UTC timestamps, to which the temporal
+        # views are restricted when it is set
+        self.window = None
         self.parse_raw_query()
 
     # Parses the query into 7 parts:
@@ -89,28 +130,31 @@ class MoveQuery:
         self.column_functions = functions
         self.column_names = names
 
-    def resolve_types(self, db):
-        sql = self.get_typeof_sql()
-        types = None
-        with psycopg.connect(
-                host=db['host'],
-                port=db['port'],
-                dbname=db['database'],
-                user=db['username'],
-                password=db['password']) as conn:
+    # Resolves the column types from the description of the prepared
+    # query, without executing it. Type names are looked up from the
+    # result column oids, and cached in type_names for later queries.
+    def resolve_types(self, conn, type_names):
+        sql = self.get_full_sql().encode(conn.info.encoding)
+        res = conn.pgconn.prepare(b"", sql)
+        if res.status == pq.ExecStatus.COMMAND_OK:
+            res = conn.pgconn.describe_prepared(b"")
+        if res.status != pq.ExecStatus.COMMAND_OK:
+            msg = res.error_field(pq.DiagnosticField.MESSAGE_PRIMARY)
+            self.error_msg = msg.decode() if msg else "Could not prepare query"
+            return False
+        if res.nfields != len(self.column_names):
+            self.error_msg = f"Query returns {res.nfields} columns, expected {len(self.column_names)}"
+            return False
+        oids = [res.ftype(i) for i in range(res.nfields)]
+        missing = [oid for oid in set(oids) if oid not in type_names]
+        if missing:
             with conn.cursor() as cur:
-                try:
-                    cur.execute(sql)
-                    types = list(cur.fetchone())
-                except psycopg.Error as e:
-                    self.error_msg = e.diag.message_primary
-                except TypeError:
-                    self.error_msg = "Query returned 0 tuples"
-                conn.commit()
-        if types is not None:
-            self.column_types = types
-            return True
-        return False
+                cur.execute(
+                    "select oid::int, format_type(oid, null) from pg_type where oid = any(%s)",
+                    (missing, ))
+                type_names.update(cur.fetchall())
+        self.column_types = [type_names[oid] for oid in oids]
+        return True
 
     def get_column_ids_by_type(self, types, inclusive=True):
         if isinstance(types, str):
@@ -139,78 +183,465 @@ class MoveQuery:
     def has_temp_columns(self):
         return len(self.temp_cols()) > 0
 
-    def create_geom_view(self, project_title, db):
-        select_sql = self.get_geom_select_sql()
-        view_name = f"move_{project_title}_geom_{self.id}"
-        sql = f"create materialized view {view_name} as ({select_sql})"
+    # Estimates the rows, row width and cost of the query from its plan,
+    # and projects the rows of the views derived from it. A tpoint view has
+    # a row per sequence of a value, and a tgeom view a row per instant.
+    # With a row per value, the views are at least as large. Only when this
+    # lower bound is within max_rows, and the query reads a single table,
+    # the rows per value are averaged over a sample of the table, so that
+    # the query itself is never run. Otherwise the lower bound is returned.
+    def estimate(self, conn, max_rows):
+        with conn.cursor() as cur:
+            cur.execute(f"explain (format json) {self.get_full_sql()}")
+            plan = cur.fetchone()[0][0]['Plan']
+            rows = plan['Plan Rows']
+            width = plan['Plan Width']
+            derived_rows = rows * len(self.temp_cols())
+            sampled = not self.has_temp_columns()
+            if not sampled and derived_rows <= max_rows:
+                sample_sql = self.get_sample_sql(conn)
+                if sample_sql is not None:
+                    cur.execute(sample_sql)
+                    derived_rows = rows * sum(cur.fetchone())
+                    sampled = True
+        if self.has_geom_columns():
+            derived_rows += rows
+        return {
+            'rows': rows,
+            'width': width,
+            'cost': plan['Total Cost'],
+            'derived_rows': derived_rows,
+            'sampled': sampled,
+            'size_bytes': rows * width
+        }
+
+    # Average number of rows per value in each temporal view, over a sample
+    # of the table of the query, or None when it cannot be sampled
+    def get_sample_sql(self, conn):
+        rest_sql = self.get_tablesample_sql(conn, self.sample_percent)
+        if rest_sql is None:
+            return None
+        sample = MoveQuery(self.get_full_sql())
+        sample.column_types = list(self.column_types)
+        sample.rest_sql = rest_sql
+        sample.apply_limit(self.sample_rows)
+        cols = []
+        for i in self.temp_cols():
+            col = self.column_names[i]
+            if self.window is not None:
+                col = f"atTime({col}, {self.get_window_span()})"
+            if self.get_temporal_kind(i) == 'tgeom':
+                rows = f"numInstants({col})"
+            else:
+                rows = f"st_numgeometries(geometry({col}, true))"
+            cols.append(f"coalesce(avg(coalesce({rows}, 0)), 1)::float")
+        return f"select {', '.join(cols)} from ({sample.get_base_select_sql()}) as sample"
+
+    # Rest of the query, after from, reading percent of the pages of its
+    # relation with tablesample, or None when the query does not read a
+    # single table. Views and foreign tables cannot be sampled. The sample
+    # is repeatable.
+    def get_tablesample_sql(self, conn, percent):
+        match = re.fullmatch(
+            r"((\w+(?:\.\w+)?)(?: (?:as )?(?!where\b|group\b|order\b|window\b)\w+)?)"
+            r"((?: (?:where|group|order|window)\b.*)?)", self.rest_sql)
+        if self.has_with or not match:
+            return None
+        with conn.cursor() as cur:
+            cur.execute(
+                "select relkind from pg_class where oid = to_regclass(%s)",
+                (match.group(2), ))
+            res = cur.fetchone()
+        if res is None or res[0] not in ('r', 'm', 'p'):
+            return None
+        return f"{match.group(1)} tablesample system ({percent}) repeatable (0){match.group(3)}"
+
+    # Returns a sample of the query for a quick preview. A query that reads
+    # a single table samples percent of its pages, and every query is
+    # limited to rows. The sample is repeatable, so that the preview views
+    # of a query can be reused.
+    def get_preview_query(self, conn, percent, rows):
+        preview = MoveQuery(self.get_full_sql())
+        preview.column_types = list(self.column_types)
+        preview.materialization = self.materialization
+        preview.extent = self.extent
+        preview.window = self.window
+        rest_sql = self.get_tablesample_sql(conn, percent)
+        if rest_sql is not None:
+            preview.rest_sql = rest_sql
+        preview.apply_limit(rows)
+        preview.raw_sql = preview.get_full_sql()
+        return preview
+
+    def apply_limit(self, limit):
+        if self.has_limit and int(self.value_sql) <= limit:
+            return
+        self.has_limit = True
+        self.limit_sql = "limit"
+        self.value_sql = str(limit)
+        self.raw_sql = self.get_full_sql()
+
+    # Replaces the temporal columns by their trajectory, so that the query
+    # gives a single geometry view instead of the much larger temporal ones
+    def use_trajectories(self):
+        for i in self.temp_cols():
+            self.columns_sql[i] = f"trajectory({self.column_functions[i]}) as {self.column_names[i]}"
+            self.column_functions[i] = f"trajectory({self.column_functions[i]})"
+            if self.column_types[i] == 'tgeogpoint':
+                self.column_types[i] = 'geography'
+            else:
+                self.column_types[i] = 'geometry'
+        self.raw_sql = self.get_full_sql()
+
+    # Hash of the normalized query, the kind of view and the column, so
+    # that running the same query again gives the same view names
+    def get_fingerprint(self, kind, col_id=None):
+        sql = re.sub(r"\s*([(),=<>+*/-])\s*", r"\1", self.get_full_sql())
+        key = f"{kind}:{col_id}:{sql}"
+        if self.extent is not None and kind != 'base':
+            key += f":{self.extent}"
+        if self.window is not None and kind not in ('base', 'geom'):
+            key += f":{self.window}"
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def get_base_name(self, project_title):
+        return f"move_{project_title}_base_{self.get_fingerprint('base')}"
+
+    def get_temporal_kind(self, col_id):
+        if self.column_types[col_id] == 'tgeometry':
+            return 'tgeom'
+        return 'tpoint'
+
+    def get_view_name(self, project_title, kind, col_id=None):
+        fingerprint = self.get_fingerprint(kind, col_id)
+        if col_id is None:
+            return f"move_{project_title}_{kind}_{fingerprint}"
+        return f"move_{project_title}_{kind}_{str(col_id)}_{fingerprint}"
+
+    # Names of the base table and views built for this query
+    def get_relation_names(self, project_title):
+        names = [self.get_base_name(project_title)]
+        if self.has_geom_columns():
+            names.append(self.get_view_name(project_title, 'geom'))
+        for col_id in self.temp_cols():
+            names.append(
+                self.get_view_name(project_title,
+                                   self.get_temporal_kind(col_id), col_id))
+        return names
+
+    # Runs the query once into an unlogged table, from which all the geom
+    # and temporal views of the query are derived
+    def create_base_table(self, project_title, conn, progress):
+        base_name = self.get_base_name(project_title)
+        select_sql = self.get_base_select_sql()
+        sql = f"create unlogged table {base_name} as ({select_sql})"
+        index_sqls = self.get_base_index_sqls(base_name)
+        analyze_sql = f"analyze {base_name}"
+        with conn.cursor() as cur:
+            with progress.phase('build', conn, poll=True):
+                with pipeline(conn):
+                    cur.execute(sql)
+                    for index_sql in index_sqls:
+                        conn.cursor().execute(index_sql)
+                    conn.cursor().execute(analyze_sql)
+                    conn.commit()
+            progress.rows = cur.rowcount
+        return base_name
+
+    # Query that fills the base table or the given view
+    def get_select_sql(self, project_title, kind, col_id=None):
+        base_name = self.get_base_name(project_title)
+        if kind == 'base':
+            return self.get_base_select_sql()
+        elif kind == 'geom':
+            return self.get_geom_select_sql(base_name)
+        elif kind == 'tgeom':
+            return self.get_tgeom_select_sql(base_name, col_id)
+        return self.get_tpoint_select_sql(base_name, col_id)
+
+    # Unlogged tables skip the write-ahead log, and are emptied on crash
+    # recovery, which is fine for relations that can be rebuilt
+    def get_create_sql(self, view_name, select_sql):
+        if self.materialization == 'table':
+            return f"create unlogged table {view_name} as ({select_sql})"
+        return f"create materialized view {view_name} as ({select_sql})"
+
+    # Qualified names of the tables read by the query, taken from its plan,
+    # in which views are already expanded into their tables
+    def get_source_relations(self, conn):
+        with conn.cursor() as cur:
+            cur.execute(
+                f"explain (verbose, format json) {self.get_base_select_sql()}")
+            plan = cur.fetchone()[0][0]['Plan']
+        relations = set()
+        nodes = [plan]
+        while nodes:
+            node = nodes.pop()
+            if 'Relation Name' in node:
+                relations.add(f"{node['Schema']}.{node['Relation Name']}")
+            nodes.extend(node.get('Plans', []))
+        return sorted(relations)
+
+    def create_geom_view(self, project_title, conn, progress):
+        select_sql = self.get_select_sql(project_title, 'geom')
+        view_name = self.get_view_name(project_title, 'geom')
+        sql = self.get_create_sql(view_name, select_sql)
+        index_sqls = self.get_index_sqls('geom', view_name)
         analyze_sql = f"analyze {view_name}"
         geom_cols = self.geom_cols()
         col_names = [self.column_names[col] for col in geom_cols]
         srids = []
         geom_types = []
-        with psycopg.connect(
-                host=db['host'],
-                port=db['port'],
-                dbname=db['database'],
-                user=db['username'],
-                password=db['password']) as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql)
-                cur.execute(analyze_sql)
-                for col_name in col_names:
-                    sql = f"select distinct st_srid({col_name}), geometrytype({col_name}) from {view_name} where {col_name} is not null"
+        with conn.cursor() as cur:
+            # The view creation and the srid probes of all the geometry
+            # columns are sent in a single round trip
+            with progress.phase('build', conn, poll=True):
+                with pipeline(conn):
                     cur.execute(sql)
-                    res = cur.fetchall()
-                    col_srids = set()
-                    col_geom_types = set()
-                    for srid, geom_type in res:
-                        col_srids.add(srid)
-                        if geom_type.lower() in ['point', 'multipoint']:
-                            col_geom_types.add('multipoint')
-                        elif geom_type.lower() in ['linestring', 'multilinestring']:
-                            col_geom_types.add('multilinestring')
-                        elif geom_type.lower() in ['polygon', 'multipolygon']:
-                            col_geom_types.add('multipolygon')
-                    if len(col_srids) > 1:
-                        raise ValueError(f"Geometry column {col_name} has multiple SRIDS: {str(col_srids)}")
-                    elif len(col_geom_types) == 0:
-                        raise ValueError(f"No supported geometry types in geometry column {col_name}")
-                    srids.append(col_srids.pop())
-                    geom_types.append(col_geom_types)
-                conn.commit()
+                    for index_sql in index_sqls:
+                        conn.cursor().execute(index_sql)
+                    conn.cursor().execute(analyze_sql)
+                    srid_curs = []
+                    for col_name in col_names:
+                        sql = f"select distinct st_srid({col_name}), geometrytype({col_name}) from {view_name} where {col_name} is not null"
+                        srid_curs.append(conn.cursor())
+                        srid_curs[-1].execute(sql)
+            progress.rows = cur.rowcount
+            for col_name, srid_cur in zip(col_names, srid_curs):
+                res = srid_cur.fetchall()
+                col_srids = set()
+                col_geom_types = set()
+                for srid, geom_type in res:
+                    col_srids.add(srid)
+                    if geom_type.lower() in ['point', 'multipoint']:
+                        col_geom_types.add('multipoint')
+                    elif geom_type.lower() in ['linestring', 'multilinestring']:
+                        col_geom_types.add('multilinestring')
+                    elif geom_type.lower() in ['polygon', 'multipolygon']:
+                        col_geom_types.add('multipolygon')
+                if len(col_srids) > 1:
+                    raise ValueError(f"Geometry column {col_name} has multiple SRIDS: {str(col_srids)}")
+                elif len(col_geom_types) == 0:
+                    raise ValueError(f"No supported geometry types in geometry column {col_name}")
+                srids.append(col_srids.pop())
+                geom_types.append(col_geom_types)
+            conn.commit()
         return view_name, col_names, srids, geom_types
 
-    def create_temporal_view(self, project_title, db, col_id):
-        if self.column_types[col_id] == 'tgeometry':
-            select_sql = self.get_tgeom_select_sql(col_id)
-            view_name = f"move_{project_title}_tgeom_{str(col_id)}_{self.id}"
+    def create_temporal_view(self, project_title, conn, col_id, progress):
+        kind = self.get_temporal_kind(col_id)
+        select_sql = self.get_select_sql(project_title, kind, col_id)
+        view_name = self.get_view_name(project_title, kind, col_id)
+        partitions = None
+        if self.partitions > 0:
+            base_name = self.get_base_name(project_title)
+            partitions = self.get_partitions(conn, base_name, col_id,
+                                             view_name)
+            sqls = self.get_partitioned_create_sqls(view_name, select_sql,
+                                                    partitions)
+            fill_sqls = [
+                self.get_partition_insert_sql(base_name, view_name, col_id,
+                                              partitions, i)
+                for i in range(len(partitions))
+            ]
         else:
-            select_sql = self.get_tpoint_select_sql(col_id)
-            view_name = f"move_{project_title}_tpoint_{str(col_id)}_{self.id}"
-        sql = f"create materialized view {view_name} as ({select_sql})"
-        col_name = self.column_names[col_id]
+            sqls = []
+            fill_sqls = [self.get_create_sql(view_name, select_sql)]
         srid_sql = f"select st_srid(geom) from {view_name} limit 1"
         analyze_sql = f"analyze {view_name}"
-        startt_idx_sql = f"create index {view_name}_startt_idx on {view_name} (start_t)"
-        endt_idx_sql = f"create index {view_name}_endt_idx on {view_name} (end_t)"
-        geom_idx_sql = f"create index {view_name}_geom_idx on {view_name} using spgist (geom)"
         srid = None
-        with psycopg.connect(
-                host=db['host'],
-                port=db['port'],
-                dbname=db['database'],
-                user=db['username'],
-                password=db['password']) as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql)
-                cur.execute(srid_sql)
-                srid = cur.fetchone()[0]
-                cur.execute(analyze_sql)
-                cur.execute(startt_idx_sql)
-                cur.execute(endt_idx_sql)
-                cur.execute(geom_idx_sql)
+        # The view is built and committed in one round trip, so that its
+        # indexes can then be built from other connections
+        with conn.cursor() as srid_cur:
+            with progress.phase('build', conn, poll=True):
+                with pipeline(conn):
+                    for sql in sqls:
+                        conn.cursor().execute(sql)
+                    fill_curs = []
+                    for sql in fill_sqls:
+                        fill_curs.append(conn.cursor())
+                        fill_curs[-1].execute(sql)
+                    srid_cur.execute(srid_sql)
+                    conn.cursor().execute(analyze_sql)
+                    conn.commit()
+            progress.rows = sum(cur.rowcount for cur in fill_curs)
+            # An empty view has no srid
+            res = srid_cur.fetchone()
+            srid = res[0] if res is not None else None
+        return view_name, srid, partitions
+
+    # Creates the empty temporal view, to be filled in parallel by the
+    # queries returned with it, one per shard of the base table, or one per
+    # partition of a partitioned view. The view is a table, since a
+    # materialized view cannot be filled afterwards.
+    def create_sharded_view(self, project_title, conn, col_id, shards):
+        kind = self.get_temporal_kind(col_id)
+        base_name = self.get_base_name(project_title)
+        select_sql = self.get_select_sql(project_title, kind, col_id)
+        view_name = self.get_view_name(project_title, kind, col_id)
+        partitions = None
+        if self.partitions > 0:
+            partitions = self.get_partitions(conn, base_name, col_id,
+                                             view_name)
+            sqls = self.get_partitioned_create_sqls(view_name, select_sql,
+                                                    partitions)
+        else:
+            sqls = [
+                f"create unlogged table {view_name} as ({select_sql}) with no data"
+            ]
+        with conn.cursor() as cur:
+            cur.execute(
+                "select pg_relation_size(%s) / current_setting('block_size')::int",
+                (base_name, ))
+            pages = cur.fetchone()[0]
+            with pipeline(conn):
+                for sql in sqls:
+                    conn.cursor().execute(sql)
                 conn.commit()
-        return view_name, srid
+        if partitions is not None:
+            insert_sqls = [
+                self.get_partition_insert_sql(base_name, view_name, col_id,
+                                              partitions, i)
+                for i in range(len(partitions))
+            ]
+        else:
+            insert_sqls = self.get_shard_insert_sqls(
+                base_name, view_name, kind, col_id, shards, pages)
+        return view_name, partitions, insert_sqls
+
+    # The base table is split into shards of consecutive pages, which are
+    # read with tid range scans. The ids of each shard are interleaved with
+    # those of the others, so that they stay unique.
+    def get_shard_insert_sqls(self, base_name, view_name, kind, col_id,
+                              shards, pages):
+        cols = [
+            col for i, col in enumerate(self.column_names)
+            if i in self.other_cols()
+        ]
+        cols = ", ".join(cols + ['geom', 'start_t', 'end_t'])
+        step = -(-max(pages, 1) // shards)
+        sqls = []
+        for i in range(shards):
+            cond = f"ctid >= '({i * step},0)'::tid"
+            if i < shards - 1:
+                cond += f" and ctid < '({(i + 1) * step},0)'::tid"
+            shard_sql = f"(select * from {base_name} where {cond}) as shard"
+            if kind == 'tgeom':
+                select_sql = self.get_tgeom_select_sql(shard_sql, col_id)
+            else:
+                select_sql = self.get_tpoint_select_sql(shard_sql, col_id)
+            sqls.append(f"""
+                insert into {view_name} (id, {cols})
+                select (id - 1) * {shards} + {i + 1}, {cols}
+                from ({select_sql}) as segments""")
+        return sqls
+
+    # Splits the time extent of the temporal column in ranges of the
+    # smallest step that gives at most about self.partitions ranges. Each
+    # partition is a [name, from, to, default] list, the last one being
+    # the default partition, for the rows outside the ranges.
+    def get_partitions(self, conn, base_name, col_id, view_name):
+        col_name = self.column_names[col_id]
+        with conn.cursor() as cur:
+            cur.execute(f"select min(startTimestamp({col_name})), max(endTimestamp({col_name})) from {base_name}")
+            lo, hi = cur.fetchone()
+        partitions = []
+        if lo is not None:
+            lo = lo.astimezone(timezone.utc)
+            hi = hi.astimezone(timezone.utc)
+            step = next((step for step in self.partition_steps
+                         if step * self.partitions >= hi - lo),
+                        self.partition_steps[-1])
+            start = lo.replace(minute=0, second=0, microsecond=0)
+            if step >= timedelta(days=1):
+                start = start.replace(hour=0)
+            while start <= hi:
+                partitions.append([
+                    f"{view_name}_p{len(partitions)}",
+                    start.isoformat(), (start + step).isoformat(), False
+                ])
+                start += step
+        partitions.append([
+            f"{view_name}_default",
+            partitions[0][1] if partitions else None,
+            partitions[-1][2] if partitions else None, True
+        ])
+        return partitions
+
+    # A partitioned table cannot be created from a query, so its columns
+    # are copied from an empty temporary table created from the query. The
+    # partitions are then filled one by one.
+    def get_partitioned_create_sqls(self, view_name, select_sql, partitions):
+        template_name = f"{view_name}_template"
+        sqls = [
+            f"create temp table {template_name} on commit drop as ({select_sql}) with no data",
+            f"create table {view_name} (like {template_name}) partition by range (start_t)"
+        ]
+        for name, start, end, default in partitions:
+            if default:
+                sqls.append(
+                    f"create unlogged table {name} partition of {view_name} default")
+            else:
+                sqls.append(
+                    f"create unlogged table {name} partition of {view_name} for values from ('{start}') to ('{end}')")
+        return sqls
+
+    # Fills the partition at index of a partitioned view. The values of the
+    # base table are clipped to the range of the partition before their
+    # segments are computed, so that no segment crosses the bounds of a
+    # partition, and a partition can be rebuilt without the others. The
+    # default partition gets the values outside the ranges. The ids of
+    # each partition are interleaved with those of the others, so that
+    # they stay unique.
+    def get_partition_insert_sql(self, base_name, view_name, col_id,
+                                 partitions, index):
+        _, start, end, default = partitions[index]
+        col_name = self.column_names[col_id]
+        cols = [
+            col for i, col in enumerate(self.column_names)
+            if i in self.other_cols()
+        ]
+        cols = ", ".join(cols + ['geom', 'start_t', 'end_t'])
+        cond = "true"
+        if start is not None:
+            span = f"tstzspan('{start}', '{end}', true, false)"
+            cond = f"start_t >= '{start}' and start_t < '{end}'"
+            clip = "minusTime" if default else "atTime"
+            base_cols = ", ".join(
+                f"{clip}({col}, {span}) as {col}" if i == col_id else col
+                for i, col in enumerate(self.column_names))
+            if default:
+                cond = f"start_t is null or not ({cond})"
+                base_name = f"(select {base_cols} from {base_name}) as part"
+            else:
+                base_name = f"(select {base_cols} from {base_name} where {col_name} && {span}) as part"
+        if self.get_temporal_kind(col_id) == 'tgeom':
+            select_sql = self.get_tgeom_select_sql(base_name, col_id)
+        else:
+            select_sql = self.get_tpoint_select_sql(base_name, col_id)
+        return f"""
+            insert into {view_name} (id, {cols})
+            select (id - 1) * {len(partitions)} + {index + 1}, {cols}
+            from ({select_sql}) as segments
+            where {cond}"""
+
+    # The unique index of a partitioned view must include start_t
+    def get_key_index_sql(self, view_name, partitioned=False):
+        if partitioned:
+            return f"create unique index {view_name}_id_idx on {view_name} (id, start_t)"
+        return f"create unique index {view_name}_id_idx on {view_name} (id)"
+
+    # Every view has a unique index on id. Temporal views are also indexed
+    # on time and geometry.
+    def get_index_sqls(self, kind, view_name):
+        if kind == 'geom':
+            return [self.get_key_index_sql(view_name)]
+        sqls = [self.get_key_index_sql(view_name, self.partitions > 0)]
+        return sqls + [
+            f"create index {view_name}_startt_idx on {view_name} (start_t)",
+            f"create index {view_name}_endt_idx on {view_name} (end_t)",
+            f"create index {view_name}_geom_idx on {view_name} using spgist (geom)"
+        ]
 
     def get_full_sql(self):
         sql_parts = []
@@ -225,52 +656,121 @@ class MoveQuery:
             sql_parts.append(self.value_sql)
         return " ".join(sql_parts)
 
-    def get_typeof_sql(self):
+    # Same as the full query, but with every column named as in
+    # column_names, so that the views can select them from the base table
+    def get_base_select_sql(self):
         sql_parts = []
         if self.has_with:
             sql_parts.append(self.with_sql)
         sql_parts.append(self.select_sql)
-        typeof_columns = [f"pg_typeof({col})" for col in self.column_functions]
-        sql_parts.append(", ".join(typeof_columns))
+        cols = [
+            col if col.partition("as")[1] else f"{col} as {self.column_names[i]}"
+            for i, col in enumerate(self.columns_sql)
+        ]
+        sql_parts.append(", ".join(cols))
         sql_parts.append(self.from_sql)
         sql_parts.append(self.rest_sql)
-        sql_parts.append("limit 1")
+        if self.has_limit:
+            sql_parts.append(self.limit_sql)
+            sql_parts.append(self.value_sql)
         return " ".join(sql_parts)
 
-    def get_geom_select_sql(self):
-        sql_parts = []
-        if self.has_with:
-            sql_parts.append(self.with_sql)
-        sql_parts.append(self.select_sql)
+    # Expression of a spatial or temporal column compared to the extent,
+    # on which the base table is indexed
+    def get_extent_expr(self, col_id):
+        col = self.column_names[col_id]
+        col_type = self.column_types[col_id]
+        if col_type == 'geography':
+            return f"({col}::geometry)"
+        elif col_type == 'tgeogpoint':
+            return f"({col}::tgeompoint)"
+        return col
+
+    # Condition keeping the rows of the base table with a value overlapping
+    # the map extent in one of the given columns. The extent is transformed
+    # once to the srid of the column, read from its first value, so that
+    # the condition can use the indexes of the base table.
+    def get_extent_filter(self, base_name, col_ids):
+        if self.extent is None:
+            return None
+        xmin, ymin, xmax, ymax, srid = self.extent
+        envelope = f"st_makeenvelope({xmin}, {ymin}, {xmax}, {ymax}, {srid})"
+        conds = []
+        for i in col_ids:
+            col = self.column_names[i]
+            col_type = self.column_types[i]
+            expr = self.get_extent_expr(i)
+            if col_type == 'geography':
+                conds.append(f"{expr} && st_transform({envelope}, 4326)")
+            elif col_type == 'geometry':
+                col_srid = f"(select st_srid({col}) from {base_name} where {col} is not null limit 1)"
+                conds.append(f"{expr} && st_transform({envelope}, {col_srid})")
+            elif col_type == 'tgeogpoint':
+                conds.append(f"{expr} && st_transform({envelope}, 4326)::stbox")
+            else:
+                col_srid = f"(select srid({col}) from {base_name} where {col} is not null limit 1)"
+                conds.append(f"{expr} && st_transform({envelope}, {col_srid})::stbox")
+        return "(" + " or ".join(conds) + ")"
+
+    # With a map extent or a time window, the base table is indexed on its
+    # spatial and temporal columns, so that the views of every extent or
+    # window only read the rows they keep
+    def get_base_index_sqls(self, base_name):
+        if self.extent is None and self.window is None:
+            return []
+        return [
+            f"create index {base_name}_{i}_idx on {base_name} using gist ({self.get_extent_expr(i)})"
+            for i in self.geom_cols() + self.temp_cols()
+        ]
+
+    def get_window_span(self):
+        start, end = self.window
+        return f"tstzspan('{start}', '{end}', true, true)"
+
+    # Condition keeping the rows of the base table whose temporal value
+    # overlaps the time window
+    def get_window_filter(self, col_id):
+        if self.window is None:
+            return None
+        return f"{self.get_extent_expr(col_id)} && {self.get_window_span()}"
+
+    # Temporal column restricted to the time window, so that only the
+    # segments or instants of the window are computed
+    def get_window_col(self, col_id):
+        col_name = self.column_names[col_id]
+        if self.window is None:
+            return col_name
+        return f"atTime({col_name}, {self.get_window_span()}) as {col_name}"
+
+    def get_where_sql(self, conds):
+        conds = [cond for cond in conds if cond is not None]
+        if not conds:
+            return ""
+        return " where " + " and ".join(conds)
+
+    def get_geom_select_sql(self, base_name):
         cols = ['row_number() over () as id']
         cols.extend([
-            col for i, col in enumerate(self.columns_sql)
+            col for i, col in enumerate(self.column_names)
             if i in self.other_cols() or i in self.geom_cols()
         ])
-        sql_parts.append(", ".join(cols))
-        sql_parts.append(self.from_sql)
-        sql_parts.append(self.rest_sql)
-        if self.has_limit:
-            sql_parts.append(self.limit_sql)
-            sql_parts.append(self.value_sql)
-        return " ".join(sql_parts)
+        cols = ", ".join(cols)
+        where_sql = self.get_where_sql(
+            [self.get_extent_filter(base_name, self.geom_cols())])
+        return f"select {cols} from {base_name}{where_sql}"
 
-    def get_tpoint_select_sql(self, col_id):
-        sql_parts = []
-        if self.has_with:
-            sql_parts.append(self.with_sql)
-        sql_parts.append(self.select_sql)
+    def get_tpoint_select_sql(self, base_name, col_id):
         inner_cols = [
-            col for i, col in enumerate(self.columns_sql)
-            if i in self.other_cols() or i == col_id
+            col for i, col in enumerate(self.column_names)
+            if i in self.other_cols()
         ]
-        sql_parts.append(", ".join(inner_cols))
-        sql_parts.append(self.from_sql)
-        sql_parts.append(self.rest_sql)
-        if self.has_limit:
-            sql_parts.append(self.limit_sql)
-            sql_parts.append(self.value_sql)
-        inner_sql = " ".join(sql_parts)
+        inner_cols.append(self.get_window_col(col_id))
+        inner_cols = ", ".join(inner_cols)
+        where_sql = self.get_where_sql([
+            self.get_extent_filter(base_name, [col_id]),
+            self.get_window_filter(col_id)
+        ])
+        inner_sql = f"select {inner_cols} from {base_name}{where_sql}"
         cols = [
             col for i, col in enumerate(self.column_names)
             if i in self.other_cols()
@@ -283,51 +783,120 @@ class MoveQuery:
             ), temp_2 as (
                 select
                     {cols},
-                    (st_dump(geometry(shiftTime({self.column_names[col_id]}, 
-                        localtime - (current_time at time zone 'utc')::time), true))).geom as geom
+                    (st_dump(geometry({self.column_names[col_id]}, true))).geom as geom
                 from temp_1
             )
             select 
                 row_number() over () as id,
                 {cols}, 
                 geom, 
-                to_timestamp(st_m(st_startpoint(geom))) at time zone 'gmt' as start_t,
-                to_timestamp(st_m(st_endpoint(geom))) at time zone 'gmt' as end_t
+                to_timestamp(st_m(st_startpoint(geom))) as start_t,
+                to_timestamp(st_m(st_endpoint(geom))) as end_t
             from temp_2"""
         else:
             sql = f"""
             with temp_1 as (
                 {inner_sql}
             ), temp_2 as (
-                select (st_dump(geometry(shiftTime({self.column_names[col_id]}, 
-                        localtime - (current_time at time zone 'utc')::time), true))).geom as geom
+                select (st_dump(geometry({self.column_names[col_id]}, true))).geom as geom
                 from temp_1
             )
             select 
                 row_number() over () as id,
                 geom, 
-                to_timestamp(st_m(st_startpoint(geom))) at time zone 'gmt' as start_t,
-                to_timestamp(st_m(st_endpoint(geom))) at time zone 'gmt' as end_t
+                to_timestamp(st_m(st_startpoint(geom))) as start_t,
+                to_timestamp(st_m(st_endpoint(geom))) as end_t
             from temp_2"""
         return sql
 
-    def get_tgeom_select_sql(self, col_id):
-        sql_parts = []
-        if self.has_with:
-            sql_parts.append(self.with_sql)
-        sql_parts.append(self.select_sql)
+    # Latest timestamp of the temporal column in the base table, from
+    # which a tpoint view can later be extended by an incremental refresh
+    def get_high_water_mark(self, conn, base_name, col_id):
+        col_name = self.column_names[col_id]
+        with conn.cursor() as cur:
+            cur.execute(f"select max(endTimestamp({col_name})) from {base_name}")
+            mark = cur.fetchone()[0]
+        return mark.isoformat() if mark is not None else None
+
+    # Latest timestamps of all the temporal columns in the base table, or
+    # None when the query has no temporal column or one of them is empty
+    def get_high_water_marks(self, conn, base_name):
+        cols = [
+            f"max(endTimestamp({self.column_names[i]}))"
+            for i in self.temp_cols()
+        ]
+        if not cols:
+            return None
+        with conn.cursor() as cur:
+            cur.execute(f"select {', '.join(cols)} from {base_name}")
+            marks = cur.fetchone()
+        if any(mark is None for mark in marks):
+            return None
+        return [mark.isoformat() for mark in marks]
+
+    # Reloads only the rows of the base table with data after marks, the
+    # latest timestamps of its temporal columns. Assuming the sources are
+    # append-only, these rows are new values, or values extended since the
+    # previous load, which replace the rows with the same other columns
+    # and start timestamps. The query still runs once, but the base table
+    # only receives the new rows.
+    def get_base_append_sqls(self, base_name, base_sql, marks):
+        delta_name = f"{base_name}_delta"
+        temp_names = [self.column_names[i] for i in self.temp_cols()]
+        new_cond = " or ".join(
+            f"endTimestamp({col}) > '{mark}'::timestamptz"
+            for col, mark in zip(temp_names, marks))
+        keys = [self.column_names[i] for i in self.other_cols()]
+        keys.extend(f"startTimestamp({col})" for col in temp_names)
+        keys = ", ".join(keys)
+        return [
+            f"create temp table {delta_name} on commit drop as select * from ({base_sql}) as q where {new_cond}",
+            f"delete from {base_name} where ({keys}) in (select {keys} from {delta_name})",
+            f"insert into {base_name} select * from {delta_name}"
+        ]
+
+    # Appends to a tpoint view the segments of the data after mark, the
+    # latest timestamp of the data the view was built from. Each object is
+    # resumed from its last instant before mark, which completes its open
+    # tail segment, and the new rows are numbered after those of the view.
+    def get_tpoint_append_sql(self, base_name, view_name, col_id, mark):
+        col_name = self.column_names[col_id]
+        mark = f"'{mark}'::timestamptz"
+        since = f"""(
+            select coalesce(max(t), startTimestamp({col_name}))
+            from unnest(timestamps({col_name})) t
+            where t <= {mark})"""
+        cols = [
+            col for i, col in enumerate(self.column_names)
+            if i in self.other_cols()
+        ]
+        delta_cols = cols + [
+            f"atTime({col_name}, tstzspan({since}, endTimestamp({col_name}), true, true)) as {col_name}"
+        ]
+        delta_sql = f"""(
+            select {", ".join(delta_cols)}
+            from {base_name}
+            where endTimestamp({col_name}) > {mark}) as delta"""
+        select_sql = self.get_tpoint_select_sql(delta_sql, col_id)
+        cols = ", ".join(cols + ['geom', 'start_t', 'end_t'])
+        return f"""
+            insert into {view_name} (id, {cols})
+            select (select coalesce(max(id), 0) from {view_name}) + id, {cols}
+            from ({select_sql}) as segments"""
+
+    def get_tgeom_select_sql(self, base_name, col_id):
         inner_cols = ["row_number() over () as tgeom_id"]
         inner_cols.extend([
-            col for i, col in enumerate(self.columns_sql)
-            if i in self.other_cols() or i == col_id
+            col for i, col in enumerate(self.column_names)
+            if i in self.other_cols()
         ])
-        sql_parts.append(", ".join(inner_cols))
-        sql_parts.append(self.from_sql)
-        sql_parts.append(self.rest_sql)
-        if self.has_limit:
-            sql_parts.append(self.limit_sql)
-            sql_parts.append(self.value_sql)
-        inner_sql = " ".join(sql_parts)
+        inner_cols.append(self.get_window_col(col_id))
+        inner_cols = ", ".join(inner_cols)
+        where_sql = self.get_where_sql([
+            self.get_extent_filter(base_name, [col_id]),
+            self.get_window_filter(col_id)
+        ])
+        inner_sql = f"select {inner_cols} from {base_name}{where_sql}"
         cols = [
             col for i, col in enumerate(self.column_names)
             if i in self.other_cols()
@@ -341,8 +910,7 @@ class MoveQuery:
                 select
                     tgeom_id,
                     {cols},
-                    unnest(instants(shiftTime({self.column_names[col_id]}, 
-                        localtime - (current_time at time zone 'utc')::time))) as inst
+                    unnest(instants({self.column_names[col_id]})) as inst
                 from tracks
             ), pairs as (
                 select 
@@ -357,8 +925,8 @@ class MoveQuery:
                 id,
                 {cols}, 
                 geom, 
-                t at time zone 'gmt' as start_t, 
-                lead(t) over (partition by tgeom_id order by t) at time zone 'gmt' as end_t 
+                t as start_t, 
+                lead(t) over (partition by tgeom_id order by t) as end_t 
             from pairs"""
         else:
             sql = f"""
@@ -367,8 +935,7 @@ class MoveQuery:
             ), insts as (
                 select
                     tgeom_id,
-                    unnest(instants(shiftTime({self.column_names[col_id]}, 
-                        localtime - (current_time at time zone 'utc')::time))) as inst
+                    unnest(instants({self.column_names[col_id]})) as inst
                 from tracks
             ), pairs as (
                 select 
@@ -381,8 +948,8 @@ class MoveQuery:
             select 
                 id,
                 geom, 
-                t at time zone 'gmt' as start_t, 
-                lead(t) over (partition by tgeom_id order by t) at time zone 'gmt' as end_t 
+                t as start_t, 
+                lead(t) over (partition by tgeom_id order by t) as end_t 
             from pairs"""
         return sql
 
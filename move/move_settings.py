@@ -0,0 +1,32 @@
+from qgis.PyQt.QtCore import QSettings
+
+# Default values of the plugin settings, stored in the QGIS settings
+# under the "move/" prefix.
+DEFAULTS = {
+    'pool_size': 8,
+    'disk_budget_mb': 1024,
+    'gc_interval_s': 300,
+    'gc_min_interval_s': 60,
+    'index_parallelism': 3,
+    'maintenance_work_mem': '256MB',
+    'max_parallel_maintenance_workers': 2,
+    'materialization': 'view',
+    'temporal_partitions': 0,
+    'build_shards': 1,
+    'preflight_max_rows': 5000000,
+    'preflight_action': 'warn',
+    'preview_percent': 0,
+    'preview_rows': 10000,
+    'extent_pushdown': False,
+    'window_pushdown': False,
+    'refresh_parallelism': 2,
+    'auto_refresh_interval_s': 0,
+    'incremental_refresh': False,
+    'streaming': False,
+    'stream_interval_ms': 1000,
+}
+
+
+def setting(key):
+    default = DEFAULTS[key]
+    return QSettings().value(f"move/{key}", default, type=type(default))
@@ -1,38 +1,770 @@
 import psycopg
+import threading
+import time
 
+from concurrent.futures import FIRST_EXCEPTION
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import contextmanager
+from datetime import datetime
+from qgis.core import Qgis
+from qgis.core import QgsMessageLog
 from qgis.core import QgsTask
 
+from .move_catalog import MoveCatalog
+from .move_catalog import drop_relations
+from .move_catalog import get_relkinds
+from .move_query import MoveQuery
+from .move_query import pipeline
+from .move_settings import setting
+
+
+class MoveProgress:
+    """Progress of a task, split into weighted phases.
+
+    During the phases that build indexes or analyze a relation, the
+    progress of the backend, or of all the backends working on the
+    relation, is polled from pg_stat_progress_create_index and
+    pg_stat_progress_analyze on another pooled connection. The poller
+    never waits for a connection, since the task holds its own while the
+    phase runs: when the pool is exhausted, the poll is skipped.
+    """
+
+    poll_sql = """
+        select sum(blocks_done), sum(blocks_total)
+        from pg_stat_progress_create_index
+        where pid = %(pid)s or relid = to_regclass(%(relation)s)
+        union all
+        select sum(sample_blks_scanned), sum(sample_blks_total)
+        from pg_stat_progress_analyze
+        where pid = %(pid)s or relid = to_regclass(%(relation)s)
+    """
+    poll_interval = 1
+
+    def __init__(self, task, weights):
+        self.task = task
+        self.weights = weights
+        self.total = sum(weights.values())
+        self.done = 0
+        self.durations = []
+        self.rows = None
+
+    def set_progress(self, done):
+        self.task.setProgress(100 * done / self.total)
+
+    @contextmanager
+    def phase(self, name, conn=None, poll=False, relation=None, weight=None):
+        if weight is None:
+            weight = self.weights[name]
+        stop = threading.Event()
+        if poll:
+            pid = conn.info.backend_pid if conn is not None else None
+            poller = threading.Thread(
+                target=self.poll,
+                args=(pid, relation, weight, stop),
+                daemon=True)
+            poller.start()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            stop.set()
+            if poll:
+                poller.join()
+        self.durations.append((name, time.monotonic() - start))
+        self.done += weight
+        self.set_progress(self.done)
+
+    def poll(self, pid, relation, weight, stop):
+        while not stop.wait(self.poll_interval):
+            try:
+                conn = self.task.pool.getconn(wait=False)
+            except psycopg.Error:
+                return
+            if conn is None:
+                continue
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(self.poll_sql, {
+                        'pid': pid,
+                        'relation': relation
+                    })
+                    res = cur.fetchall()
+            except psycopg.Error:
+                return
+            finally:
+                self.task.pool.putconn(conn)
+            for blocks_done, blocks_total in res:
+                if blocks_total:
+                    self.set_progress(
+                        self.done + weight * blocks_done / blocks_total)
+                    break
+
+    def log(self, name, action='built'):
+        phases = ", ".join(f"{phase} {duration:.2f}s"
+                           for phase, duration in self.durations)
+        total = sum(duration for _, duration in self.durations)
+        msg = f"{name} {action} in {total:.2f}s ({phases})"
+        if self.rows is not None:
+            msg += f", {self.rows} rows"
+        QgsMessageLog.logMessage(msg, 'Move', level=Qgis.Info)
+
 
 class MoveTask(QgsTask):
-    def __init__(self, description, query, project_title, db, finished_fnc,
+    def __init__(self, description, query, project_title, pool, finished_fnc,
                  failed_fnc):
         super(MoveTask, self).__init__(description, QgsTask.CanCancel)
         self.query = query
         self.project_title = project_title
-        self.db = db
+        self.pool = pool
+        self.db = pool.db
+        self.catalog = MoveCatalog(project_title)
         self.finished_fnc = finished_fnc
         self.failed_fnc = failed_fnc
         self.result_params = None
         self.error_msg = None
+        self.conns = set()
+        self.conns_lock = threading.Lock()
+
+    # Borrow a pooled connection, which is cancelled on the server if the
+    # task is cancelled while it is in use. The open transaction is then
+    # rolled back, dropping the partially created views and indexes.
+    @contextmanager
+    def connection(self):
+        with self.pool.connection() as conn:
+            with self.conns_lock:
+                if self.isCanceled():
+                    raise psycopg.errors.QueryCanceled("Task cancelled")
+                self.conns.add(conn)
+            try:
+                yield conn
+            finally:
+                with self.conns_lock:
+                    self.conns.discard(conn)
+
+    def cancel(self):
+        super(MoveTask, self).cancel()
+        self.cancel_queries()
+
+    def cancel_queries(self):
+        with self.conns_lock:
+            for conn in self.conns:
+                try:
+                    conn.cancel()
+                except psycopg.Error:
+                    pass
+
+    # Runs the statements concurrently, each on its own pooled connection
+    # with the given settings, and returns their row counts. If one of
+    # them fails, those not started yet are dropped and the others are
+    # cancelled.
+    def execute_parallel(self, sqls, max_workers, settings=None):
+        settings = settings or dict()
+
+        def execute(sql):
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    with pipeline(conn):
+                        for name, value in settings.items():
+                            conn.cursor().execute(
+                                "select set_config(%s, %s, true)",
+                                (name, value))
+                        cur.execute(sql)
+                        conn.commit()
+                    return cur.rowcount
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(execute, sql) for sql in sqls]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [future for future in done if future.exception()]
+            if failed:
+                for future in futures:
+                    future.cancel()
+                self.cancel_queries()
+                # The others now fail as cancelled, which would hide the
+                # error that stopped them
+                raise failed[0].exception()
+            return [future.result() for future in futures]
+
+    def build_indexes(self, index_sqls):
+        self.execute_parallel(
+            index_sqls, setting('index_parallelism'), {
+                'maintenance_work_mem':
+                setting('maintenance_work_mem'),
+                'max_parallel_maintenance_workers':
+                str(setting('max_parallel_maintenance_workers'))
+            })
+
+    # The catalog is only created once per pool, to keep DDL off the path
+    # of every task
+    def ensure_catalog(self, conn):
+        if not self.pool.catalog_ready:
+            self.catalog.ensure(conn)
+            self.pool.catalog_ready = True
+
+    # Forgets the reservation of a relation whose build failed or was
+    # cancelled, and drops the relation if this task had created it. A
+    # relation that failed to be created is left alone, since it may then
+    # be someone else's.
+    def drop_relation(self, name, created=True):
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    if created:
+                        drop_relations(cur, get_relkinds(cur, [name]))
+                self.catalog.release(conn, [name])
+        except psycopg.Error:
+            pass
 
     def finished(self, result):
         if result:
             self.finished_fnc(self.db, self.query, self.result_params)
+        elif self.isCanceled():
+            QgsMessageLog.logMessage(f"{self.description()}: cancelled",
+                                     'Move', level=Qgis.Info)
         else:
             self.failed_fnc(self.error_msg)
 
 
+class MovePrepareTask(MoveTask):
+    def __init__(self, description, raw_sql, project_title, pool,
+                 finished_fnc, failed_fnc, extent=None, window=None,
+                 check=True):
+        super(MovePrepareTask, self).__init__(description, None, project_title,
+                                              pool, finished_fnc, failed_fnc)
+        self.raw_sql = raw_sql
+        self.check = check
+        self.extent = extent
+        self.window = window
+        self.materialization = setting('materialization')
+        self.partitions = setting('temporal_partitions')
+        self.max_rows = setting('preflight_max_rows')
+        self.action = setting('preflight_action')
+        self.preview_percent = setting('preview_percent')
+        self.preview_rows = setting('preview_rows')
+
+    def run(self):
+        try:
+            with self.connection() as conn:
+                self.ensure_catalog(conn)
+                self.query = MoveQuery(self.raw_sql)
+                self.query.materialization = self.materialization
+                self.query.partitions = self.partitions
+                self.query.extent = self.extent
+                self.query.window = self.window
+                if not self.query.is_valid:
+                    self.error_msg = f"Invalid Query: {self.query}"
+                    return False
+                if not self.query.resolve_types(conn, self.pool.type_names):
+                    self.error_msg = self.query.error_msg
+                    return False
+                # The views of a query already built are reused as they are
+                names = self.query.get_relation_names(self.project_title)
+                if (self.check and self.max_rows > 0 and len(
+                        self.catalog.lookup(conn, names)) < len(names)):
+                    self.preflight(conn)
+                    names = self.query.get_relation_names(self.project_title)
+                preview = None
+                if self.preview_percent > 0:
+                    preview = self.query.get_preview_query(
+                        conn, self.preview_percent, self.preview_rows)
+                    names += preview.get_relation_names(self.project_title)
+                existing = self.catalog.lookup(conn, names)
+                self.catalog.touch(conn, existing.keys())
+                self.result_params = {
+                    'existing': existing,
+                    'preview': preview
+                }
+        except psycopg.Error as e:
+            self.error_msg = e.diag.message_primary
+            return False
+        return not self.isCanceled()
+
+    # Checks the estimated size of the views before building them. Over
+    # preflight_max_rows rows, a warning is logged, and the query is
+    # limited or its temporal columns replaced by their trajectories,
+    # depending on preflight_action.
+    def preflight(self, conn):
+        estimate = self.query.estimate(conn, self.max_rows)
+        at_least = "" if estimate['sampled'] else "at least "
+        QgsMessageLog.logMessage(
+            f"Estimated {estimate['rows']:.0f} rows of {estimate['width']} bytes, "
+            f"cost {estimate['cost']:.0f}, "
+            f"{at_least}{estimate['derived_rows']:.0f} rows in views", 'Move',
+            level=Qgis.Info)
+        if estimate['derived_rows'] <= self.max_rows:
+            return
+        msg = f"The views of the query are estimated at {estimate['derived_rows']:.0f} rows"
+        if self.action == 'limit':
+            ratio = estimate['derived_rows'] / max(estimate['rows'], 1)
+            limit = max(1, int(self.max_rows / ratio))
+            # Rounded down to one significant digit, so that the query, and
+            # so its views, stay the same when it is executed again on
+            # slightly different data
+            digits = 10**(len(str(limit)) - 1)
+            limit = limit // digits * digits
+            self.query.apply_limit(limit)
+            msg += f", the query is limited to {limit} rows"
+        elif self.action == 'static' and self.query.has_temp_columns():
+            self.query.use_trajectories()
+            msg += ", the temporal columns are shown as trajectories"
+        QgsMessageLog.logMessage(msg, 'Move', level=Qgis.Warning)
+
+
+class MoveCleanTask(MoveTask):
+    def __init__(self, description, project_title, pool, view_names,
+                 finished_fnc, failed_fnc):
+        super(MoveCleanTask, self).__init__(description, None, project_title,
+                                            pool, finished_fnc, failed_fnc)
+        self.view_names = view_names
+        self.budget = setting('disk_budget_mb') * 1024 * 1024
+
+    # Evicts the catalogued queries over the disk budget and drops the
+    # other unused relations, all in one transaction
+    def run(self):
+        try:
+            with self.connection() as conn:
+                self.ensure_catalog(conn)
+                self.catalog.touch(conn, self.view_names)
+                evicted = self.catalog.evict(conn, self.view_names,
+                                             self.budget)
+                dropped = self.clean(conn)
+            self.result_params = {'evicted': evicted, 'dropped': dropped}
+        except psycopg.Error as e:
+            self.error_msg = e.diag.message_primary
+            return False
+        return True
+
+    # Drop the unused materialized views and tables that are not in the
+    # catalog, like those built by older versions of the plugin. Relations
+    # being built are reserved in the catalog, and are left alone.
+    def clean(self, conn, batch_size=50):
+        table_patterns = [
+            f"move\\_{self.project_title}\\_{kind}\\_%"
+            for kind in ['base', 'geom', 'tpoint', 'tgeom']
+        ]
+        select_sql = f"""
+            select relname, relkind
+            from pg_class
+            where relnamespace = 'public'::regnamespace
+            and not relispartition
+            and (relkind = 'm'
+                and relname like 'move@_{self.project_title}@_%%' escape '@'
+                or relkind in ('r', 'p')
+                and relname like any(%s))
+            and relname <> all(%s)
+            and relname not in (select view_name from move.views)
+        """
+        with conn.cursor() as cur:
+            cur.execute(select_sql, (table_patterns, self.view_names))
+            res = cur.fetchall()
+            drop_relations(cur, res, batch_size)
+        return [name for name, _ in res]
+
+
+class MoveChangesTask(MoveTask):
+    def __init__(self, description, project_title, pool, base_names,
+                 finished_fnc, failed_fnc, relations=None):
+        super(MoveChangesTask, self).__init__(description, None,
+                                              project_title, pool,
+                                              finished_fnc, failed_fnc)
+        self.base_names = base_names
+        self.relations = relations
+
+    # Reads the modification counters of the tables the base tables were
+    # built from or, when the tables that changed are already known from
+    # their notifications, finds the base tables that read them
+    def run(self):
+        try:
+            with self.connection() as conn:
+                self.ensure_catalog(conn)
+                if self.relations is None:
+                    self.result_params = {
+                        'counters':
+                        self.catalog.get_change_counters(conn, self.base_names)
+                    }
+                else:
+                    self.result_params = {
+                        'changed':
+                        self.catalog.get_readers(conn, self.base_names,
+                                                 self.relations)
+                    }
+        except psycopg.Error as e:
+            self.error_msg = e.diag.message_primary
+            return False
+        return True
+
+
+class MoveTriggerTask(MoveTask):
+    def __init__(self, description, project_title, pool, base_names,
+                 finished_fnc, failed_fnc, install=True):
+        super(MoveTriggerTask, self).__init__(description, None,
+                                              project_title, pool,
+                                              finished_fnc, failed_fnc)
+        self.base_names = base_names
+        self.install = install
+
+    # Installs the notification trigger on the source tables of the base
+    # tables or, without install, releases the triggers used by the
+    # project, removing those that no other project uses
+    def run(self):
+        try:
+            with self.connection() as conn:
+                if self.install:
+                    self.ensure_catalog(conn)
+                    relations = self.catalog.get_source_relations(
+                        conn, self.base_names)
+                    self.catalog.install_triggers(conn, relations)
+                else:
+                    relations = self.catalog.uninstall_triggers(conn)
+            self.result_params = {
+                'relations': relations,
+                'install': self.install
+            }
+        except psycopg.Error as e:
+            self.error_msg = e.diag.message_primary
+            return False
+        return True
+
+
+class MoveRefreshTask(MoveTask):
+    def __init__(self, description, project_title, pool, view_names,
+                 finished_fnc, failed_fnc, stream=False):
+        super(MoveRefreshTask, self).__init__(description, None,
+                                              project_title, pool,
+                                              finished_fnc, failed_fnc)
+        self.view_names = view_names
+        self.stream = stream
+        self.incremental = stream or setting('incremental_refresh')
+
+    # Refreshes the views without blocking the layers that read them. The
+    # base tables of the views are reloaded once, then each view is rebuilt
+    # under another name and swapped in. With incremental refresh, tpoint
+    # tables are only extended with the new data. Views missing from the
+    # catalog are refreshed in place. A streamed refresh is always
+    # incremental, and refused for the views that would be rebuilt.
+    def run(self):
+        try:
+            with self.connection() as conn:
+                self.ensure_catalog(conn)
+                sources = {
+                    view_name: self.catalog.get_sources(conn, view_name)
+                    for view_name in self.view_names
+                }
+            if self.stream:
+                reason = self.get_stream_refusal(sources)
+                if reason is not None:
+                    QgsMessageLog.logMessage(
+                        f"Not streaming {', '.join(self.view_names)}: {reason}",
+                        'Move', level=Qgis.Warning)
+                    self.result_params = {
+                        'view_names': self.view_names,
+                        'refused': True
+                    }
+                    return True
+            bases = {
+                source['base_name']: source
+                for source in sources.values() if source is not None
+            }
+            progress = MoveProgress(self, {
+                'base': 40 / len(bases) if bases else 0,
+                'view': 60 / len(self.view_names)
+            })
+            for source in bases.values():
+                self.refresh_base(source, progress)
+            for view_name, source in sources.items():
+                if source is None:
+                    with self.connection() as conn:
+                        with progress.phase('view', conn, poll=True):
+                            conn.execute(
+                                f"refresh materialized view {view_name}")
+                            conn.commit()
+                    continue
+                query = MoveQuery(source['source_sql'])
+                query.extent = source['params'].get('extent')
+                query.window = source['params'].get('window')
+                if (self.incremental and source['kind'] == 'tpoint'
+                        and source['relkind'] == 'r'
+                        and source['params'].get('high_water_mark')):
+                    self.append_view(query, view_name, source, progress)
+                elif source['relkind'] == 'p':
+                    self.refresh_partitions(query, view_name, source,
+                                            progress)
+                elif source['relkind'] == 'm':
+                    self.swap_view(query, view_name, source, progress)
+                else:
+                    query.materialization = 'table'
+                    self.swap_view(query, view_name, source, progress)
+            with self.connection() as conn:
+                self.catalog.touch(conn, self.view_names + list(bases))
+            progress.log(", ".join(self.view_names), 'refreshed')
+            self.result_params = {'view_names': self.view_names}
+        except psycopg.Error as e:
+            self.error_msg = e.diag.message_primary
+            return False
+        except ValueError as e:
+            self.error_msg = str(e)
+            return False
+        return True
+
+    # Only the tpoint tables of a query without LIMIT can be extended with
+    # the new data of their query. Returns why the views cannot be
+    # streamed, or None.
+    def get_stream_refusal(self, sources):
+        for view_name, source in sources.items():
+            if source is None:
+                return f"{view_name} is not in the catalog"
+            query = MoveQuery(source['source_sql'])
+            if not query.is_valid:
+                return f"Invalid Query: {query}"
+            if query.has_limit:
+                return "the query has a LIMIT"
+            if source['kind'] != 'tpoint' or source['relkind'] != 'r':
+                return f"{view_name} is not an unpartitioned tpoint table"
+        return None
+
+    # The layers never read the base table, so it can be truncated. With
+    # incremental refresh, only the rows with new data are reloaded, unless
+    # the query is limited, since its rows could then change at any time.
+    def refresh_base(self, source, progress):
+        base_name = source['base_name']
+        query = MoveQuery(source['source_sql'])
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                with progress.phase('base', conn, poll=True):
+                    marks = None
+                    if (self.incremental and query.is_valid
+                            and not query.has_limit):
+                        if not query.resolve_types(conn,
+                                                   self.pool.type_names):
+                            raise ValueError(query.error_msg)
+                        marks = query.get_high_water_marks(conn, base_name)
+                    if marks is not None:
+                        sqls = query.get_base_append_sqls(
+                            base_name, source['base_sql'], marks)
+                    else:
+                        sqls = [
+                            f"truncate {base_name}",
+                            f"insert into {base_name} {source['base_sql']}"
+                        ]
+                    with pipeline(conn):
+                        for sql in sqls[:-1]:
+                            conn.cursor().execute(sql)
+                        cur.execute(sqls[-1])
+                        conn.cursor().execute(f"analyze {base_name}")
+                        conn.commit()
+                progress.rows = cur.rowcount
+
+    # Assumes the sources are append-only: rows of the view are never
+    # updated, only new segments are added
+    def append_view(self, query, view_name, source, progress):
+        base_name = source['base_name']
+        col_id = source['params']['col_id']
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                with progress.phase('view', conn, poll=True):
+                    if not query.resolve_types(conn, self.pool.type_names):
+                        raise ValueError(query.error_msg)
+                    mark = query.get_high_water_mark(conn, base_name, col_id)
+                    cur.execute(
+                        query.get_tpoint_append_sql(
+                            base_name, view_name, col_id,
+                            source['params']['high_water_mark']))
+                    cur.execute(f"analyze {view_name}")
+                    self.catalog.update_params(conn, view_name,
+                                               {'high_water_mark': mark})
+                    conn.commit()
+
+    # Each partition is refreshed in its own transaction, by deleting its
+    # rows rather than truncating it, so that the layer can still read it.
+    # Each one is only computed from the values overlapping its range.
+    # Partitions that no longer exist are skipped. With incremental
+    # refresh, the sources are append-only, so only the partitions ending
+    # after the high water mark of the view, and the default one, change.
+    def refresh_partitions(self, query, view_name, source, progress):
+        params = source['params']
+        partitions = params['partitions']
+        mark = params.get('high_water_mark') if self.incremental else None
+        names = [
+            name for name, start, end, default in partitions
+            if default or mark is None or start is None
+            or datetime.fromisoformat(end) > datetime.fromisoformat(mark)
+        ]
+        with self.connection() as conn:
+            if not query.resolve_types(conn, self.pool.type_names):
+                raise ValueError(query.error_msg)
+            with conn.cursor() as cur:
+                cur.execute(
+                    "select p from unnest(%s::text[]) p where to_regclass(p) is null",
+                    (names, ))
+                missing = [name for name, in cur.fetchall()]
+        if missing:
+            QgsMessageLog.logMessage(
+                f"{view_name}: missing partitions {', '.join(missing)}",
+                'Move', level=Qgis.Warning)
+        names = [name for name in names if name not in missing]
+        self.refresh_partition_names(query, view_name, source, names,
+                                     progress)
+
+    # Refreshes the given partitions of a partitioned view, and moves the
+    # high water mark of a tpoint view to the refreshed data
+    def refresh_partition_names(self, query, view_name, source, names,
+                                progress):
+        partitions = source['params']['partitions']
+        col_id = source['params']['col_id']
+        weight = progress.weights['view'] / max(len(names), 1)
+        for i, (name, start, end, default) in enumerate(partitions):
+            if name not in names:
+                continue
+            with self.connection() as conn:
+                with progress.phase('view', conn, poll=True, weight=weight):
+                    with pipeline(conn):
+                        conn.cursor().execute(f"delete from {name}")
+                        conn.cursor().execute(
+                            query.get_partition_insert_sql(
+                                source['base_name'], view_name, col_id,
+                                partitions, i))
+                        conn.cursor().execute(f"analyze {name}")
+                        conn.commit()
+        if source['kind'] == 'tpoint':
+            with self.connection() as conn:
+                mark = query.get_high_water_mark(conn, source['base_name'],
+                                                 col_id)
+                self.catalog.update_params(conn, view_name,
+                                           {'high_water_mark': mark})
+                conn.commit()
+
+    # A materialized view is rebuilt rather than refreshed concurrently,
+    # since its ids are row numbers that change from one build to the
+    # next, which would make a concurrent refresh rewrite every row
+    def swap_view(self, query, view_name, source, progress):
+        new_name = f"{view_name}_new"
+        relation = 'materialized view' if source['relkind'] == 'm' else 'table'
+        weight = progress.weights['view'] / 2
+        with self.connection() as conn:
+            self.catalog.reserve(conn, query, source['kind'],
+                                 source['params'].get('col_id'), new_name)
+        created = False
+        try:
+            with self.connection() as conn:
+                with progress.phase('view', conn, poll=True, weight=weight):
+                    with pipeline(conn):
+                        conn.cursor().execute(
+                            f"drop {relation} if exists {new_name}")
+                        conn.cursor().execute(
+                            query.get_create_sql(new_name,
+                                                 source['select_sql']))
+                        conn.cursor().execute(f"analyze {new_name}")
+                        conn.commit()
+            created = True
+            with progress.phase('index', poll=True, relation=new_name,
+                                weight=weight):
+                self.build_indexes(
+                    query.get_index_sqls(source['kind'], new_name))
+            # The old view is only locked for the swap itself
+            with self.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        select indexname
+                        from pg_indexes
+                        where schemaname = 'public' and tablename = %s
+                    """, (new_name, ))
+                    index_names = [name for name, in cur.fetchall()]
+                    cur.execute(f"drop {relation} {view_name}")
+                    cur.execute(
+                        f"alter {relation} {new_name} rename to {view_name}")
+                    for name in index_names:
+                        suffix = name[len(new_name):]
+                        cur.execute(
+                            f"alter index {name} rename to {view_name}{suffix}")
+                    if source['kind'] == 'tpoint':
+                        mark = query.get_high_water_mark(
+                            conn, source['base_name'],
+                            source['params']['col_id'])
+                        self.catalog.update_params(
+                            conn, view_name, {'high_water_mark': mark})
+                    self.catalog.release(conn, [new_name])
+                    conn.commit()
+        except BaseException:
+            self.drop_relation(new_name, created)
+            raise
+
+
+class MoveStageTask(MoveTask):
+    def __init__(self, description, query, project_title, pool, finished_fnc,
+                 failed_fnc):
+        super(MoveStageTask, self).__init__(description, query, project_title,
+                                            pool, finished_fnc, failed_fnc)
+        self.streaming = setting('streaming')
+
+    def run(self):
+        try:
+            progress = MoveProgress(self, {'build': 100})
+            base_name = self.query.get_base_name(self.project_title)
+            with self.connection() as conn:
+                self.catalog.reserve(conn, self.query, 'base')
+            created = False
+            try:
+                with self.connection() as conn:
+                    self.query.create_base_table(self.project_title, conn,
+                                                 progress)
+                    created = True
+                    sources = self.query.get_source_relations(conn)
+                    self.catalog.register(conn, self.query, 'base', None,
+                                          {'sources': sources}, progress)
+            except BaseException:
+                self.drop_relation(base_name, created)
+                raise
+            if self.streaming:
+                with self.connection() as conn:
+                    try:
+                        self.catalog.install_triggers(conn, sources)
+                    except psycopg.Error as e:
+                        conn.rollback()
+                        QgsMessageLog.logMessage(
+                            f"Could not install notification triggers: {e.diag.message_primary}",
+                            'Move', level=Qgis.Warning)
+            progress.log(base_name)
+            self.result_params = {'base_name': base_name}
+        except psycopg.Error as e:
+            self.error_msg = e.diag.message_primary
+            return False
+        except ValueError as e:
+            self.error_msg = str(e)
+            return False
+        return True
+
+
 class MoveGeomTask(MoveTask):
-    def __init__(self, description, query, project_title, db, finished_fnc,
+    def __init__(self, description, query, project_title, pool, finished_fnc,
                  failed_fnc):
         super(MoveGeomTask, self).__init__(description, query, project_title,
-                                           db, finished_fnc, failed_fnc)
+                                           pool, finished_fnc, failed_fnc)
 
     def run(self):
         try:
-            view_name, col_names, srids, geom_types = self.query.create_geom_view(
-                self.project_title, self.db)
+            progress = MoveProgress(self, {'build': 100})
+            view_name = self.query.get_view_name(self.project_title, 'geom')
+            with self.connection() as conn:
+                self.catalog.reserve(conn, self.query, 'geom')
+            created = False
+            try:
+                with self.connection() as conn:
+                    view_name, col_names, srids, geom_types = self.query.create_geom_view(
+                        self.project_title, conn, progress)
+                    created = True
+                    self.catalog.register(conn, self.query, 'geom', None, {
+                        'col_names': col_names,
+                        'srids': srids,
+                        'geom_types': [sorted(types) for types in geom_types],
+                        'extent': self.query.extent
+                    }, progress)
+            except BaseException:
+                self.drop_relation(view_name, created)
+                raise
+            progress.log(view_name)
             self.result_params = {
+                'base_name': self.query.get_base_name(self.project_title),
                 'view_name': view_name,
                 'col_names': col_names,
                 'srids': srids,
@@ -48,22 +780,87 @@ class MoveGeomTask(MoveTask):
 
 
 class MoveTTask(MoveTask):
-    def __init__(self, description, query, project_title, db, col_id,
+    def __init__(self, description, query, project_title, pool, col_id,
                  finished_fnc, failed_fnc):
-        super(MoveTTask, self).__init__(description, query, project_title, db,
-                                        finished_fnc, failed_fnc)
+        super(MoveTTask, self).__init__(description, query, project_title,
+                                        pool, finished_fnc, failed_fnc)
         self.col_id = col_id
+        self.shards = setting('build_shards')
 
+    # The view is committed before its indexes are built, so once created,
+    # it is dropped if anything fails or the task is cancelled before it
+    # is registered
     def run(self):
         try:
-            view_name, srid = self.query.create_temporal_view(
-                self.project_title, self.db, self.col_id)
+            progress = MoveProgress(self, {'build': 60, 'index': 40})
+            kind = self.query.get_temporal_kind(self.col_id)
+            view_name = self.query.get_view_name(self.project_title, kind,
+                                                 self.col_id)
+            with self.connection() as conn:
+                self.catalog.reserve(conn, self.query, kind, self.col_id)
+            created = False
+            try:
+                if self.shards > 1:
+                    with self.connection() as conn:
+                        view_name, partitions, insert_sqls = self.query.create_sharded_view(
+                            self.project_title, conn, self.col_id, self.shards)
+                    created = True
+                    srid = self.fill_shards(view_name, insert_sqls, progress)
+                else:
+                    with self.connection() as conn:
+                        view_name, srid, partitions = self.query.create_temporal_view(
+                            self.project_title, conn, self.col_id, progress)
+                    created = True
+                with progress.phase('index', poll=True, relation=view_name):
+                    self.build_indexes(
+                        self.query.get_index_sqls(kind, view_name))
+                params = {
+                    'col_id': self.col_id,
+                    'srid': srid,
+                    'extent': self.query.extent,
+                    'window': self.query.window
+                }
+                if partitions is not None:
+                    params['partitions'] = partitions
+                with self.connection() as conn:
+                    if kind == 'tpoint':
+                        params['high_water_mark'] = self.query.get_high_water_mark(
+                            conn, self.query.get_base_name(self.project_title),
+                            self.col_id)
+                    self.catalog.register(conn, self.query, kind, self.col_id,
+                                          params, progress)
+            except BaseException:
+                self.drop_relation(view_name, created)
+                raise
+            progress.log(view_name)
             self.result_params = {
                 'col_id': self.col_id,
+                'base_name': self.query.get_base_name(self.project_title),
                 'view_name': view_name,
                 'srid': srid
             }
         except psycopg.Error as e:
             self.error_msg = e.diag.message_primary
             return False
-        return True
\ No newline at end of file
+        except ValueError as e:
+            self.error_msg = str(e)
+            return False
+        return True
+
+    # Fills the empty view from shards of the base table, each computed on
+    # its own pooled connection, so that the work is spread over several
+    # backends, and returns the srid of the view
+    def fill_shards(self, view_name, insert_sqls, progress):
+        with progress.phase('build'):
+            rows = self.execute_parallel(insert_sqls, self.shards)
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"select st_srid(geom) from {view_name} limit 1")
+                res = cur.fetchone()
+                srid = res[0] if res is not None else None
+                cur.execute(f"analyze {view_name}")
+                conn.commit()
+        progress.rows = sum(rows)
+        QgsMessageLog.logMessage(f"{view_name}: {len(insert_sqls)} shards",
+                                 'Move', level=Qgis.Info)
+        return srid